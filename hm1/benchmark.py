@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import log_analyzer_reduced as analyzer
+from log_generator import generate_log, DEFAULT_LINES, DEFAULT_URLS
+
+
+BLOCK_SIZE = 1024 * 1024
+PHASES = ["read", "decompress", "parse", "aggregate", "render"]
+
+
+def get_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def iter_decompressed(raw_blocks, timings):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for raw_block in raw_blocks:
+        started = time.perf_counter()
+        data = decompressor.decompress(raw_block)
+        # concatenated gzip members, as produced by `cat a.gz b.gz`
+        while decompressor.eof and decompressor.unused_data:
+            unused_data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += decompressor.decompress(unused_data)
+        timings["decompress"] += time.perf_counter() - started
+        yield data
+
+
+def iter_raw_blocks(log_path, timings, counters):
+    with open(log_path, "rb") as log_file:
+        while True:
+            started = time.perf_counter()
+            raw_block = log_file.read(BLOCK_SIZE)
+            timings["read"] += time.perf_counter() - started
+            if not raw_block:
+                break
+            counters["bytes_read"] += len(raw_block)
+            yield raw_block
+
+
+def parse_lines(lines, parser, add, timings, counters):
+    started = time.perf_counter()
+    parsed = []
+    for log_line in lines:
+        try:
+            href, response_time = parser(log_line)
+            parsed.append((href, float(response_time)))
+        except analyzer.PARSE_ERRORS:
+            counters["errors"] += 1
+    counters["lines"] += len(lines)
+    timings["parse"] += time.perf_counter() - started
+
+    started = time.perf_counter()
+    for href, response_time in parsed:
+        add(href, response_time)
+    timings["aggregate"] += time.perf_counter() - started
+
+
+def run_phases(log_path, config, report_path):
+    # Single pass over the log in blocks so every phase is timed on the same
+    # data without keeping the whole file in memory.
+    timings = dict.fromkeys(PHASES, 0.0)
+    counters = {"bytes_read": 0, "bytes_decompressed": 0, "lines": 0, "errors": 0}
+    parser = analyzer.build_parser(config)
+    aggregate = analyzer.LogAggregate(
+        config.get("MEDIAN_MODE", analyzer.MEDIAN_MODE_SKETCH),
+        config.get("MAX_TRACKED_URLS")
+    )
+    add = aggregate.add
+
+    blocks = iter_raw_blocks(log_path, timings, counters)
+    if analyzer.is_gzip_file(log_path):
+        blocks = iter_decompressed(blocks, timings)
+
+    tail = b""
+    for block in blocks:
+        counters["bytes_decompressed"] += len(block)
+        started = time.perf_counter()
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        timings["parse"] += time.perf_counter() - started
+        parse_lines(lines, parser, add, timings, counters)
+    if tail:
+        # the last line has no newline after it
+        parse_lines([tail], parser, add, timings, counters)
+
+    started = time.perf_counter()
+    report_data = analyzer.build_report(
+        aggregate,
+        config.get("MAX_REPORT_SIZE", 1000),
+        config.get("REPORT_SORT_KEY", analyzer.DEFAULT_REPORT_SORT_KEY)
+    )
+    analyzer.render_template(analyzer.REPORT_TEMPLATE_PATH, report_path, report_data)
+    timings["render"] += time.perf_counter() - started
+
+    return timings, counters, len(aggregate.urls)
+
+
+def run_end_to_end(log_path, config):
+    started = time.perf_counter()
+    aggregate = analyzer.aggregate_log_file(
+        log_path,
+        analyzer.build_parser(config),
+        median_mode=config.get("MEDIAN_MODE", analyzer.MEDIAN_MODE_SKETCH),
+        workers=config.get("WORKERS", 1),
+        max_urls=config.get("MAX_TRACKED_URLS"),
+        gzip_reader=config.get("GZIP_READER", analyzer.GZIP_READER_STREAM)
+    )
+    return time.perf_counter() - started, aggregate.total_records
+
+
+def run_benchmark(log_path, config):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        timings, counters, distinct_urls = run_phases(log_path, config, os.path.join(tmp_dir, "report.html"))
+    end_to_end_seconds, _ = run_end_to_end(log_path, config)
+
+    total_seconds = sum(timings.values())
+    return {
+        "version": get_version(),
+        "python": platform.python_version(),
+        "log": {
+            "path": log_path,
+            "gzip": analyzer.is_gzip_file(log_path),
+            "bytes": counters["bytes_read"],
+            "bytes_decompressed": counters["bytes_decompressed"],
+            "lines": counters["lines"],
+            "errors": counters["errors"],
+            "distinct_urls": distinct_urls,
+        },
+        "config": config,
+        "phases": timings,
+        "decompress_mb_per_sec": (
+            counters["bytes_decompressed"] / 1024 / 1024 / timings["decompress"] if timings["decompress"] else None
+        ),
+        "total_seconds": total_seconds,
+        "lines_per_sec": counters["lines"] / total_seconds if total_seconds else None,
+        "end_to_end": {
+            "seconds": end_to_end_seconds,
+            "lines_per_sec": counters["lines"] / end_to_end_seconds if end_to_end_seconds else None,
+        },
+        "peak_rss_kb": get_peak_rss_kb(),
+    }
+
+
+def compare_results(current, baseline):
+    # relative change per metric, positive means slower / bigger
+    def change(new, old):
+        return (new - old) / old * 100 if old else None
+
+    comparison = {phase: change(current["phases"][phase], baseline["phases"][phase]) for phase in PHASES}
+    comparison["total_seconds"] = change(current["total_seconds"], baseline["total_seconds"])
+    comparison["end_to_end"] = change(current["end_to_end"]["seconds"], baseline["end_to_end"]["seconds"])
+    comparison["peak_rss_kb"] = change(current["peak_rss_kb"], baseline["peak_rss_kb"])
+    return {"baseline_version": baseline.get("version"), "change_percent": comparison}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the log analyzer on a real or synthetic log")
+    parser.add_argument("log_path", nargs="?", help="Log to analyze, a synthetic one is generated if omitted")
+    parser.add_argument("--lines", type=int, default=DEFAULT_LINES, help="Synthetic log size")
+    parser.add_argument("--urls", type=int, default=DEFAULT_URLS, help="Synthetic log url cardinality")
+    parser.add_argument("--gzip", action="store_true", help="Compress the synthetic log")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Share of broken synthetic lines")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--parser", default=analyzer.DEFAULT_LOG_PARSER, choices=sorted(analyzer.LOG_PARSERS))
+    parser.add_argument("--median-mode", default=analyzer.MEDIAN_MODE_SKETCH, choices=analyzer.MEDIAN_MODES)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--gzip-reader", default=analyzer.GZIP_READER_STREAM, choices=analyzer.GZIP_READERS)
+    parser.add_argument("--normalize", action="store_true", help="Turn on url normalization")
+    parser.add_argument("--max-urls", type=int, default=None)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    parser.add_argument("--baseline", help="JSON result of a previous run to compare with")
+    return parser.parse_args()
+
+
+def main(args):
+    config = {
+        "LOG_PARSER": args.parser,
+        "MEDIAN_MODE": args.median_mode,
+        "WORKERS": args.workers,
+        "GZIP_READER": args.gzip_reader,
+        "URL_NORMALIZATION": args.normalize,
+        "MAX_TRACKED_URLS": args.max_urls,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_path = args.log_path
+        if not log_path:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630" + (".gz" if args.gzip else ""))
+            generate_log(log_path, args.lines, args.urls, args.gzip, args.malformed_rate, args.seed)
+        result = run_benchmark(log_path, config)
+        if not args.log_path:
+            result["log"]["path"] = None
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            result["comparison"] = compare_results(result, json.load(baseline_file))
+
+    output = json.dumps(result, indent=4)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main(parse_args())
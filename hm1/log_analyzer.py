@@ -9,17 +9,24 @@
 import log_analyzer_reduced
 config = {
     "REPORTS_DIR": "./reports",
+    "REPORT_MODE": "daily",
     "LOG_DIR": "./log",
     "LOG_FILE": "./log/log.log",
     "LOGS_DIR": "./nginx/logs",
     "ERRORS_LIMIT": 25,
-    "MAX_REPORT_SIZE": 1000
+    "MAX_REPORT_SIZE": 1000,
+    "REPORT_SORT_KEY": "time_sum",
+    "REPORT_FORMATS": ["html"],
+    "MEDIAN_MODE": "sketch",
+    "LOG_PARSER": "bytes",
+    "WORKERS": 1,
+    "GZIP_READER": "block"
 }
 
 
-def main():
-    log_analyzer_reduced.main(config)
+def main(config_from_file=None):
+    log_analyzer_reduced.main(config, config_from_file)
 
 
 if __name__ == "__main__":
-    main()
+    main(log_analyzer_reduced.load_user_config())
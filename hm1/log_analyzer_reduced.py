@@ -6,11 +6,22 @@ import re
 import gzip
 import argparse
 import io
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import namedtuple
 import statistics
+import math
+import heapq
 import itertools
+import time
+import operator
 import copy
+import shutil
+import subprocess
+import contextlib
+import csv
+import hashlib
+import functools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 
 DEFAULT_CONFIG_PATH = ""
@@ -33,6 +44,51 @@ LOG_RECORD_RE = re.compile(
     '(?P<time>\d+\.\d+)'  # request_time
 )
 
+MEDIAN_MODE_SKETCH = "sketch"
+MEDIAN_MODE_EXACT = "exact"
+MEDIAN_MODES = (MEDIAN_MODE_SKETCH, MEDIAN_MODE_EXACT)
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MIN_VALUE = 1e-6
+REPORT_SORT_METRICS = {
+    "count": operator.attrgetter("count"),
+    "time_sum": operator.attrgetter("time_sum"),
+    "time_max": operator.attrgetter("time_max"),
+    "time_avg": lambda url_stat: url_stat.time_sum / url_stat.count,
+    "time_med": lambda url_stat: url_stat.times.quantile(0.5),
+}
+DEFAULT_REPORT_SORT_KEY = "time_sum"
+OTHER_URL = "__other__"
+REPORT_FIELDS = ["url", "count", "count_perc", "time_sum", "time_perc", "time_avg", "time_max", "time_med"]
+SIDECAR_FORMATS = ("jsonl", "csv")
+REPORT_MODE_DAILY = "daily"
+REPORT_MODE_ROLLING = "rolling"
+DEFAULT_URL_RULES = [
+    [r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "{uuid}"],
+    [r"(?<=/)\d+(?=/|$)", "{id}"],
+    [r"(?<=/)(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{16,}(?=/|$)", "{hex}"],
+]
+URL_CACHE_SIZE = 100000
+CHECKPOINT_HEAD_SIZE = 4096
+CHECKPOINT_SCAN_BLOCK_SIZE = 64 * 1024
+GZIP_READER_STREAM = "stream"
+GZIP_READER_BLOCK = "block"
+GZIP_READER_PIPE = "pipe"
+GZIP_READERS = (GZIP_READER_STREAM, GZIP_READER_BLOCK, GZIP_READER_PIPE)
+GZIP_BLOCK_SIZE = 8 * 1024 * 1024
+GZIP_PIPE_COMMANDS = [["pigz", "-dc"], ["zcat"], ["gzip", "-dc"]]
+PARALLEL_MIN_RANGE_SIZE = 1024 * 1024
+PARALLEL_RANGES_PER_WORKER = 4
+
+SNAPSHOT_FILENAME_RE = re.compile(r'^snapshot-(?P<date>\d{8})\.json\.gz$')
+LOG_FILENAME_RE = re.compile(r'^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$')
+
+LOG_RECORD_BYTES_RE = re.compile(LOG_RECORD_RE.pattern.encode())
+# UnicodeDecodeError is a ValueError too
+PARSE_ERRORS = (ValueError, IndexError)
+DEFAULT_LOG_PARSER = "split"
+BENCHMARK_SAMPLE_LINES = 200000
+BENCHMARK_REPEAT = 3
+
 DateNamedFileInfo = namedtuple('DateNamedFileInfo', ['file_path', 'file_date'])
 
 
@@ -47,58 +103,255 @@ def load_conf(conf_path):
 ####################################
 
 
-def create_report(records, max_records):
-    total_records = 0
-    total_time = 0
-    intermediate_data = {}
+class QuantileSketch:
+    # Log-bucketed histogram: every value lands in a bucket whose bounds are
+    # within ``relative_accuracy`` of each other, so quantiles are estimated
+    # with that relative error and memory depends on the range of values,
+    # not on how many of them were added. Two sketches merge by adding counts.
+    __slots__ = ("relative_accuracy", "log_gamma", "bins", "zeros", "count")
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value < SKETCH_MIN_VALUE:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.zeros += other.zeros
+        bins = self.bins
+        for key, count in other.bins.items():
+            bins[key] = bins.get(key, 0) + count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                # middle of the bucket (gamma^(key-1), gamma^key]
+                return 2 * math.exp(key * self.log_gamma) / (1 + math.exp(self.log_gamma))
+        return math.exp(max(self.bins) * self.log_gamma)
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zeros": self.zeros,
+            "count": self.count,
+            "bins": {str(key): count for key, count in self.bins.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        sketch.zeros = data["zeros"]
+        sketch.count = data["count"]
+        sketch.bins = {int(key): count for key, count in data["bins"].items()}
+        return sketch
+
+
+class ExactQuantiles:
+    __slots__ = ("values",)
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def merge(self, other):
+        self.values.extend(other.values)
+
+    def quantile(self, q):
+        if not self.values:
+            return None
+        if q == 0.5:
+            return statistics.median(self.values)
+        values = sorted(self.values)
+        return values[int(round(q * (len(values) - 1)))]
+
+    def to_dict(self):
+        return {"values": self.values}
+
+    @classmethod
+    def from_dict(cls, data):
+        quantiles = cls()
+        quantiles.values = list(data["values"])
+        return quantiles
+
+
+class UrlStat:
+    __slots__ = ("count", "time_sum", "time_max", "times")
+
+    def __init__(self, times):
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.times = times
+
+    def add(self, response_time):
+        self.count += 1
+        self.time_sum += response_time
+        if response_time > self.time_max:
+            self.time_max = response_time
+        self.times.add(response_time)
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        self.times.merge(other.times)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "time_sum": self.time_sum,
+            "time_max": self.time_max,
+            "times": self.times.to_dict()
+        }
+
+    @classmethod
+    def from_dict(cls, data, times_cls):
+        url_stat = cls(times_cls.from_dict(data["times"]))
+        url_stat.count = data["count"]
+        url_stat.time_sum = data["time_sum"]
+        url_stat.time_max = data["time_max"]
+        return url_stat
+
+
+class LogAggregate:
+    def __init__(self, median_mode=MEDIAN_MODE_SKETCH, max_urls=None):
+        if median_mode not in MEDIAN_MODES:
+            raise ValueError(f"Unknown median mode: {median_mode}")
+        self.median_mode = median_mode
+        # once max_urls distinct urls are tracked, new ones go to OTHER_URL
+        self.max_urls = max_urls
+        self.urls = {}
+        self.total_records = 0
+        self.total_time = 0.0
+        self.errors = 0
+
+    @property
+    def times_cls(self):
+        if self.median_mode == MEDIAN_MODE_EXACT:
+            return ExactQuantiles
+        return QuantileSketch
+
+    def new_times(self):
+        return self.times_cls()
+
+    def add(self, href, response_time):
+        self.total_records += 1
+        self.total_time += response_time
+        url_stat = self.urls.get(href)
+        if url_stat is None:
+            url_stat = self.new_url_stat(href)
+        url_stat.add(response_time)
 
+    def new_url_stat(self, href):
+        if self.max_urls is not None and len(self.urls) >= self.max_urls:
+            href = OTHER_URL
+            url_stat = self.urls.get(href)
+            if url_stat is not None:
+                return url_stat
+        url_stat = self.urls[href] = UrlStat(self.new_times())
+        return url_stat
+
+    def merge(self, other):
+        self.total_records += other.total_records
+        self.total_time += other.total_time
+        self.errors += other.errors
+        for href, other_stat in other.urls.items():
+            url_stat = self.urls.get(href)
+            if url_stat is None:
+                url_stat = self.new_url_stat(href)
+            url_stat.merge(other_stat)
+
+    def to_dict(self):
+        return {
+            "median_mode": self.median_mode,
+            "max_urls": self.max_urls,
+            "total_records": self.total_records,
+            "total_time": self.total_time,
+            "errors": self.errors,
+            "urls": {href: url_stat.to_dict() for href, url_stat in self.urls.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregate = cls(data["median_mode"], data.get("max_urls"))
+        aggregate.total_records = data["total_records"]
+        aggregate.total_time = data["total_time"]
+        aggregate.errors = data["errors"]
+        times_cls = aggregate.times_cls
+        aggregate.urls = {
+            href: UrlStat.from_dict(url_stat, times_cls) for href, url_stat in data["urls"].items()
+        }
+        return aggregate
+
+
+def aggregate_records(records, median_mode=MEDIAN_MODE_SKETCH, max_urls=None):
+    aggregate = LogAggregate(median_mode, max_urls)
+    add = aggregate.add
     for href, response_time in records:
-        total_records += 1
-        total_time += float(response_time)
-        if href in intermediate_data:
-            intermediate_data[href]["records"] += 1
-            intermediate_data[href]["times"].append(float(response_time))
-        else:
-            intermediate_data.update({
-                href: {
-                    "records": 1,
-                    "times": [float(response_time)]
-                }
-            })
-
-    intermediate_data = dict(itertools.islice(intermediate_data.items(), max_records))
-    return [
-        {
-            "url": key,
-            "count": intermediate_data[key]["records"],
-            "time_sum": sum(intermediate_data[key]["times"]),
-            "time_avg": sum(intermediate_data[key]["times"]) / len(intermediate_data[key]["times"]),
-            "time_max": max(intermediate_data[key]["times"]),
-            "time_med": statistics.median(intermediate_data[key]["times"]),
-            "time_perc": sum(intermediate_data[key]["times"]) / total_time * 100,
-            "count_perc": intermediate_data[key]["records"] / total_records * 100
-        } for key in intermediate_data
-    ]
-
-
-def get_log_records(log_path, parser, errors_limit=None):
-    open_fn = gzip.open if is_gzip_file(log_path) else io.open
-    errors = 0
-    records = 0
-    log_records = []
-    with open_fn(log_path, mode='rb') as log_file:
-        for log_line in log_file:
-            records += 1
-            try:
-                log_records.append(parser(log_line))
-            except UnicodeDecodeError:
-                errors += 1
+        add(href, float(response_time))
+    return aggregate
+
+
+def select_top_urls(aggregate, max_records, sort_key=DEFAULT_REPORT_SORT_KEY):
+    try:
+        metric = REPORT_SORT_METRICS[sort_key]
+    except KeyError:
+        raise ValueError(f"Unknown report sort key: {sort_key}")
+    # nlargest keeps a heap of max_records items, so it is O(n log k)
+    # instead of sorting every distinct url
+    return heapq.nlargest(max_records, aggregate.urls.items(), key=lambda item: metric(item[1]))
+
+
+def iter_report_rows(aggregate, max_records, sort_key=DEFAULT_REPORT_SORT_KEY):
+    total_records = aggregate.total_records
+    total_time = aggregate.total_time
+    for href, url_stat in select_top_urls(aggregate, max_records, sort_key):
+        time_sum = url_stat.time_sum
+        count = url_stat.count
+        yield {
+            "url": href,
+            "count": count,
+            "time_sum": time_sum,
+            "time_avg": time_sum / count,
+            "time_max": url_stat.time_max,
+            "time_med": url_stat.times.quantile(0.5),
+            "time_perc": time_sum / total_time * 100 if total_time else 0,
+            "count_perc": count / total_records * 100
+        }
 
+
+def build_report(aggregate, max_records, sort_key=DEFAULT_REPORT_SORT_KEY):
+    return list(iter_report_rows(aggregate, max_records, sort_key))
+
+
+def create_report(records, max_records, median_mode=MEDIAN_MODE_SKETCH, sort_key=DEFAULT_REPORT_SORT_KEY):
+    return build_report(aggregate_records(records, median_mode), max_records, sort_key)
+
+
+def check_errors_limit(errors, records, errors_limit):
     if errors_limit is not None and records > 0 and errors / float(records) > errors_limit:
         raise RuntimeError('Errors limit exceeded')
 
-    return log_records
-
 
 def parse_log_record(log_line):
     decoded_line = log_line.decode("utf-8")
@@ -107,6 +360,540 @@ def parse_log_record(log_line):
     return href, request_time
 
 
+def parse_log_record_bytes(log_line):
+    # only the href is decoded; float() accepts the request_time bytes as is
+    request_start = log_line.index(b'"') + 1
+    request_end = log_line.index(b'"', request_start)
+    href_start = log_line.index(b' ', request_start, request_end) + 1
+    href_end = log_line.rindex(b' ', href_start, request_end)
+    request_time = log_line[log_line.rindex(b' ') + 1:]
+    return log_line[href_start:href_end].decode("utf-8"), request_time
+
+
+def parse_log_record_strict(log_line):
+    match = LOG_RECORD_BYTES_RE.match(log_line)
+    if match is None:
+        raise ValueError("Malformed log line")
+    return match.group("href").decode("utf-8"), match.group("time")
+
+
+LOG_PARSERS = {
+    "split": parse_log_record,
+    "bytes": parse_log_record_bytes,
+    "regex": parse_log_record_strict,
+}
+
+
+def get_log_parser(name):
+    try:
+        return LOG_PARSERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown log parser: {name}")
+
+
+def read_sample_lines(log_path, limit):
+    open_fn = gzip.open if is_gzip_file(log_path) else io.open
+    with open_fn(log_path, mode='rb') as log_file:
+        return list(itertools.islice(log_file, limit))
+
+
+def benchmark_parsers(log_path, limit=BENCHMARK_SAMPLE_LINES, repeat=BENCHMARK_REPEAT):
+    lines = read_sample_lines(log_path, limit)
+    results = {"lines": len(lines)}
+    # "noop" is the bare loop, i.e. the best any parser could do
+    candidates = dict(LOG_PARSERS, noop=lambda log_line: log_line)
+    for name, parser in candidates.items():
+        best = None
+        for _ in range(repeat):
+            errors = 0
+            started = time.perf_counter()
+            for log_line in lines:
+                try:
+                    parser(log_line)
+                except PARSE_ERRORS:
+                    errors += 1
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {
+            "seconds": best,
+            "lines_per_sec": len(lines) / best if best else None,
+            "errors": errors
+        }
+    return results
+
+
+class UrlNormalizer:
+    # Rules are compiled once; results are memoized because the same raw
+    # href tends to repeat a lot within a log. Instances are picklable so
+    # they can be shipped to the parallel workers.
+    def __init__(self, rules=None, strip_query=True, cache_size=URL_CACHE_SIZE):
+        if rules is None:
+            rules = DEFAULT_URL_RULES
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.strip_query = strip_query
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def __call__(self, href):
+        url = self.cache.get(href)
+        if url is not None:
+            return url
+
+        url = href
+        if self.strip_query:
+            url = url.split("?", 1)[0].split("#", 1)[0]
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[href] = url
+        return url
+
+
+class NormalizingParser:
+    def __init__(self, parser, normalizer):
+        self.parser = parser
+        self.normalizer = normalizer
+
+    def __call__(self, log_line):
+        href, request_time = self.parser(log_line)
+        return self.normalizer(href), request_time
+
+
+def build_parser(config):
+    parser = get_log_parser(config.get('LOG_PARSER', DEFAULT_LOG_PARSER))
+    if config.get('URL_NORMALIZATION'):
+        normalizer = UrlNormalizer(config.get('URL_RULES'), config.get('URL_STRIP_QUERY', True))
+        parser = NormalizingParser(parser, normalizer)
+    return parser
+
+
+####################################
+# Parallel processing
+####################################
+
+
+def aggregate_lines(lines, parser, new_aggregate):
+    aggregate = new_aggregate()
+    add = aggregate.add
+    for log_line in lines:
+        try:
+            href, response_time = parser(log_line)
+            response_time = float(response_time)
+        except PARSE_ERRORS:
+            aggregate.errors += 1
+            continue
+        add(href, response_time)
+    return aggregate
+
+
+def read_file_range(log_path, start, end):
+    if start >= end:
+        return
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(start)
+        position = start
+        for log_line in log_file:
+            yield log_line
+            position += len(log_line)
+            if position >= end:
+                break
+
+
+def split_file_ranges(log_path, parts, start=0, end=None):
+    if end is None:
+        end = os.path.getsize(log_path)
+    if parts <= 1 or end <= start:
+        return [(start, end)]
+
+    step = (end - start) // parts
+    boundaries = [start]
+    with open(log_path, 'rb') as log_file:
+        for part in range(1, parts):
+            position = max(start + part * step, boundaries[-1] + 1)
+            if position >= end:
+                break
+            # move to the start of the first line beginning at or after position
+            log_file.seek(position - 1)
+            log_file.readline()
+            boundary = min(log_file.tell(), end)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if boundaries[-1] != end:
+        boundaries.append(end)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def aggregate_file_range(log_path, parser, new_aggregate, file_range):
+    start, end = file_range
+    return aggregate_lines(read_file_range(log_path, start, end), parser, new_aggregate)
+
+
+def iter_lines(block):
+    # only b"\n" ends a line, like when iterating a file; splitlines() also
+    # splits on a stray \r in a url or user agent
+    return io.BytesIO(block)
+
+
+def aggregate_block(parser, new_aggregate, block):
+    return aggregate_lines(iter_lines(block), parser, new_aggregate)
+
+
+class DecompressStats:
+    __slots__ = ("bytes", "seconds")
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def mb_per_sec(self):
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds else None
+
+
+def get_gzip_pipe_command(log_path):
+    for command in GZIP_PIPE_COMMANDS:
+        if shutil.which(command[0]):
+            return command + [log_path]
+    return None
+
+
+@contextlib.contextmanager
+def open_gzip_stream(log_path, reader=GZIP_READER_BLOCK):
+    command = get_gzip_pipe_command(log_path) if reader == GZIP_READER_PIPE else None
+    if command is None:
+        if reader == GZIP_READER_PIPE:
+            logging.info("No external gzip decompressor found, falling back to the gzip module")
+        with gzip.open(log_path, mode='rb') as log_file:
+            yield log_file
+        return
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=GZIP_BLOCK_SIZE)
+    try:
+        yield process.stdout
+    except BaseException:
+        # the consumer stopped early, e.g. on the errors limit
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        # e.g. a truncated or corrupted archive
+        raise RuntimeError(f"{command[0]} failed with exit code {process.returncode}")
+
+
+def read_gzip_blocks(log_path, block_size=GZIP_BLOCK_SIZE, reader=GZIP_READER_BLOCK, stats=None):
+    # yields decompressed data in big newline-aligned blocks: one read call per
+    # block instead of one per line
+    if stats is None:
+        stats = DecompressStats()
+    tail = b''
+    with open_gzip_stream(log_path, reader) as log_file:
+        while True:
+            started = time.perf_counter()
+            data = log_file.read(block_size)
+            stats.seconds += time.perf_counter() - started
+            if not data:
+                break
+            stats.bytes += len(data)
+            data = tail + data
+            last_newline = data.rfind(b'\n')
+            if last_newline == -1:
+                tail = data
+                continue
+            tail = data[last_newline + 1:]
+            yield data[:last_newline + 1]
+    if tail:
+        yield tail
+
+
+def iter_block_lines(blocks):
+    for block in blocks:
+        yield from iter_lines(block)
+
+
+def aggregate_ranges_parallel(log_path, parser, new_aggregate, workers, start, end):
+    parts = min(
+        workers * PARALLEL_RANGES_PER_WORKER,
+        max(1, (end - start) // PARALLEL_MIN_RANGE_SIZE)
+    )
+    ranges = split_file_ranges(log_path, parts, start, end)
+    task = functools.partial(aggregate_file_range, log_path, parser, new_aggregate)
+    aggregate = new_aggregate()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(task, ranges):
+            aggregate.merge(partial)
+    return aggregate
+
+
+def aggregate_blocks_parallel(blocks, parser, new_aggregate, workers):
+    # the decompressing process must not run ahead of the pool, otherwise the
+    # whole decompressed log ends up queued in memory
+    max_pending = workers * 2
+    task = functools.partial(aggregate_block, parser, new_aggregate)
+    aggregate = new_aggregate()
+    pending = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for block in blocks:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    aggregate.merge(future.result())
+            pending.add(executor.submit(task, block))
+        for future in pending:
+            aggregate.merge(future.result())
+    return aggregate
+
+
+def aggregate_log_file(log_path, parser, errors_limit=None, median_mode=MEDIAN_MODE_SKETCH, workers=1,
+                       start=0, end=None, max_urls=None, gzip_reader=GZIP_READER_STREAM):
+    # start/end are byte offsets and only apply to plain text logs
+    if workers is not None and workers <= 0:
+        workers = os.cpu_count() or 1
+    new_aggregate = functools.partial(LogAggregate, median_mode, max_urls)
+
+    if is_gzip_file(log_path):
+        if gzip_reader not in GZIP_READERS:
+            raise ValueError(f"Unknown gzip reader: {gzip_reader}")
+        stats = DecompressStats()
+        if workers and workers > 1:
+            # workers need blocks anyway, line by line reading makes no sense here
+            reader = GZIP_READER_BLOCK if gzip_reader == GZIP_READER_STREAM else gzip_reader
+            blocks = read_gzip_blocks(log_path, reader=reader, stats=stats)
+            aggregate = aggregate_blocks_parallel(blocks, parser, new_aggregate, workers)
+        elif gzip_reader == GZIP_READER_STREAM:
+            with gzip.open(log_path, mode='rb') as log_file:
+                aggregate = aggregate_lines(log_file, parser, new_aggregate)
+        else:
+            blocks = read_gzip_blocks(log_path, reader=gzip_reader, stats=stats)
+            aggregate = aggregate_lines(iter_block_lines(blocks), parser, new_aggregate)
+        if stats.bytes:
+            logging.info('Decompressed {:.1f} MB of "{}" in {:.2f}s of reads ({:.1f} MB/s)'.format(
+                stats.bytes / 1024 / 1024, os.path.normpath(log_path), stats.seconds, stats.mb_per_sec or 0))
+    else:
+        if end is None:
+            end = os.path.getsize(log_path)
+        if not workers or workers == 1:
+            aggregate = aggregate_file_range(log_path, parser, new_aggregate, (start, end))
+        else:
+            aggregate = aggregate_ranges_parallel(log_path, parser, new_aggregate, workers, start, end)
+
+    check_errors_limit(aggregate.errors, aggregate.total_records + aggregate.errors, errors_limit)
+    return aggregate
+
+
+####################################
+# Checkpoints
+####################################
+
+
+def get_file_identity(log_path, head_size=CHECKPOINT_HEAD_SIZE):
+    # inode alone is not enough: logrotate happily reuses them
+    stat = os.stat(log_path)
+    with open(log_path, 'rb') as log_file:
+        head = log_file.read(head_size)
+    return {
+        "device": stat.st_dev,
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "head_size": len(head),
+        "head_sha1": hashlib.sha1(head).hexdigest()
+    }
+
+
+def is_same_file(log_path, identity):
+    try:
+        current = get_file_identity(log_path, identity["head_size"])
+    except (OSError, KeyError):
+        return False
+    return (
+        current["device"] == identity["device"]
+        and current["inode"] == identity["inode"]
+        and current["size"] >= identity["size"]
+        and current["head_sha1"] == identity["head_sha1"]
+    )
+
+
+def get_checkpoint_path(checkpoint_dir, log_path):
+    return os.path.join(checkpoint_dir, os.path.basename(log_path) + ".json")
+
+
+def load_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path, "r") as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+    except (ValueError, OSError):
+        logging.exception(f"Broken checkpoint {checkpoint_path}, starting from scratch")
+        return None
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    checkpoint_dir = os.path.dirname(checkpoint_path)
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def find_last_line_end(log_path, start, end):
+    # offset right after the last complete line in [start, end): a log that is
+    # still being written may end with half a line
+    position = end
+    with open(log_path, 'rb') as log_file:
+        while position > start:
+            block_start = max(start, position - CHECKPOINT_SCAN_BLOCK_SIZE)
+            log_file.seek(block_start)
+            block = log_file.read(position - block_start)
+            last_newline = block.rfind(b'\n')
+            if last_newline != -1:
+                return block_start + last_newline + 1
+            position = block_start
+    return start
+
+
+def analyze_log_incrementally(log_info, config, is_complete):
+    log_path = log_info.file_path
+    median_mode = config.get('MEDIAN_MODE', MEDIAN_MODE_SKETCH)
+    checkpoint_path = get_checkpoint_path(config['CHECKPOINT_DIR'], log_path)
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    if (checkpoint and checkpoint.get("median_mode") == median_mode
+            and is_same_file(log_path, checkpoint["file"])):
+        if checkpoint["completed"]:
+            return LogAggregate.from_dict(checkpoint["aggregate"]), False
+        aggregate = LogAggregate.from_dict(checkpoint["aggregate"])
+        offset = checkpoint["offset"]
+    else:
+        aggregate = LogAggregate(median_mode, config.get('MAX_TRACKED_URLS'))
+        offset = 0
+
+    identity = get_file_identity(log_path)
+    size = identity["size"]
+    if is_gzip_file(log_path):
+        # compressed logs are rotated ones, there is nothing to resume inside them
+        end = size
+        is_complete = True
+    else:
+        end = size if is_complete else find_last_line_end(log_path, offset, size)
+
+    if end > offset:
+        logging.info('Collecting data from "{}" starting at byte {}'.format(os.path.normpath(log_path), offset))
+        aggregate.merge(aggregate_log_file(
+            log_path,
+            build_parser(config),
+            config.get('ERRORS_LIMIT'),
+            median_mode,
+            config.get('WORKERS', 1),
+            offset,
+            end,
+            config.get('MAX_TRACKED_URLS'),
+            config.get('GZIP_READER', GZIP_READER_STREAM)
+        ))
+
+    save_checkpoint(checkpoint_path, {
+        "file": identity,
+        "offset": end,
+        "completed": is_complete,
+        "median_mode": median_mode,
+        "aggregate": aggregate.to_dict()
+    })
+    return aggregate, end > offset
+
+
+####################################
+# Snapshots and rolling reports
+####################################
+
+
+def get_snapshot_path(snapshots_dir, file_date):
+    return os.path.join(snapshots_dir, "snapshot-{}.json.gz".format(file_date.strftime("%Y%m%d")))
+
+
+def save_snapshot(snapshots_dir, file_date, aggregate):
+    if not os.path.exists(snapshots_dir):
+        os.makedirs(snapshots_dir)
+    snapshot_path = get_snapshot_path(snapshots_dir, file_date)
+    tmp_path = snapshot_path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as snapshot_file:
+        json.dump(aggregate.to_dict(), snapshot_file, separators=(",", ":"))
+    os.replace(tmp_path, snapshot_path)
+    return snapshot_path
+
+
+def load_snapshot(snapshot_path):
+    with gzip.open(snapshot_path, "rt", encoding="utf-8") as snapshot_file:
+        return LogAggregate.from_dict(json.load(snapshot_file))
+
+
+def get_snapshots_info(snapshots_dir):
+    if not os.path.isdir(snapshots_dir):
+        return []
+
+    snapshots_info = []
+    for filename in os.listdir(snapshots_dir):
+        match = SNAPSHOT_FILENAME_RE.match(filename)
+        if not match:
+            continue
+        try:
+            file_date = datetime.strptime(match.group("date"), "%Y%m%d").date()
+        except ValueError:
+            continue
+        snapshots_info.append(DateNamedFileInfo(os.path.join(snapshots_dir, filename), file_date))
+
+    return sorted(snapshots_info, key=lambda snapshot_info: snapshot_info.file_date)
+
+
+def merge_snapshots(snapshots_info, median_mode=MEDIAN_MODE_SKETCH, max_urls=None):
+    aggregate = LogAggregate(median_mode, max_urls)
+    for snapshot_info in snapshots_info:
+        snapshot = load_snapshot(snapshot_info.file_path)
+        if snapshot.median_mode != median_mode:
+            logging.error('Skip snapshot "{}": median mode {} is not {}'.format(
+                snapshot_info.file_path, snapshot.median_mode, median_mode))
+            continue
+        aggregate.merge(snapshot)
+    return aggregate
+
+
+def get_rolling_report_path(reports_dir, window, end_date):
+    report_filename = "report-rolling-{}d-{}.html".format(window, end_date.strftime("%Y.%m.%d"))
+    return os.path.join(reports_dir, report_filename)
+
+
+def build_rolling_reports(config, force=False):
+    # rolling reports only merge the per-day snapshots, raw logs are never read
+    snapshots_info = get_snapshots_info(config['SNAPSHOTS_DIR'])
+    if not snapshots_info:
+        logging.info('No snapshots for rolling reports yet')
+        return
+
+    end_date = snapshots_info[-1].file_date
+    for window in config.get('ROLLING_WINDOWS', []):
+        report_file_path = get_rolling_report_path(config['REPORTS_DIR'], window, end_date)
+        if not force and os.path.isfile(report_file_path):
+            continue
+
+        start_date = end_date - timedelta(days=window - 1)
+        window_snapshots = [
+            snapshot_info for snapshot_info in snapshots_info if snapshot_info.file_date >= start_date
+        ]
+        if len(window_snapshots) < window:
+            logging.info('Only {} of {} days have snapshots for the rolling report'.format(
+                len(window_snapshots), window))
+        aggregate = merge_snapshots(
+            window_snapshots,
+            config.get('MEDIAN_MODE', MEDIAN_MODE_SKETCH),
+            config.get('MAX_TRACKED_URLS')
+        )
+        write_report(aggregate, report_file_path, config)
+
+
 ####################################
 # Utils
 ####################################
@@ -119,64 +906,160 @@ def setup_logger(log_path):
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
 
 
-def get_latest_log_info(files_dir):
+def get_log_files_info(files_dir):
     if not os.path.isdir(files_dir):
-        return None
+        return []
 
-    latest_file_info = None
-    latest_date = None
-    lateset_path = None
+    files_info = []
     for filename in os.listdir(files_dir):
-        match = re.match(
-            r'^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$', filename)
+        match = LOG_FILENAME_RE.match(filename)
         if not match:
             continue
 
         try:
-            possibly_date = datetime.strptime(
+            file_date = datetime.strptime(
                 match.group("date"), "%Y%m%d").date()
-        except Exception as e:
-            possibly_date = None
+        except ValueError:
             logging.error("An error when parse date from file name")
-        
-        if not latest_date or (possibly_date and possibly_date > latest_date):
-            lateset_path = f"{files_dir}/{filename}"
-            latest_date = possibly_date
-
-    latest_file_info = DateNamedFileInfo(
-        lateset_path,
-        latest_date
-    )
+            continue
+
+        files_info.append(DateNamedFileInfo(f"{files_dir}/{filename}", file_date))
+
+    return sorted(files_info, key=lambda file_info: file_info.file_date)
+
+
+def get_latest_log_info(files_dir):
+    files_info = get_log_files_info(files_dir)
+    return files_info[-1] if files_info else None
 
-    return latest_file_info
+
+def get_report_path(reports_dir, file_date):
+    report_filename = "report-{}.html".format(file_date.strftime("%Y.%m.%d"))
+    return os.path.join(reports_dir, report_filename)
 
 
 def is_gzip_file(file_path):
     return file_path.split('.')[-1] == 'gz'
 
 
-def render_template(template_path, to, data):
+def dump_report_row(row):
+    # "</" would close the <script> block the table is embedded in
+    return json.dumps(row).replace("</", "<\\/")
+
+
+def render_template(template_path, to, data, sidecars=None):
+    # data may be any iterable of rows, it is consumed once and written row by
+    # row to the html report and to the optional {"jsonl": path, "csv": path}
+    # sidecar files
     if data is None:
         data = []
+    sidecars = sidecars or {}
     with open(template_path, "r") as template:
-        changed_template = template.read().replace("$table_json", str(data))
-    with open(to, "w") as report_file:
-        report_file.write(changed_template)
+        head, placeholder, tail = template.read().partition("$table_json")
+
+    with contextlib.ExitStack() as stack:
+        report_file = stack.enter_context(open(to + ".tmp", "w"))
+        jsonl_file = csv_writer = None
+        if sidecars.get("jsonl"):
+            jsonl_file = stack.enter_context(open(sidecars["jsonl"] + ".tmp", "w"))
+        if sidecars.get("csv"):
+            csv_file = stack.enter_context(open(sidecars["csv"] + ".tmp", "w", newline=""))
+            csv_writer = csv.DictWriter(csv_file, fieldnames=REPORT_FIELDS)
+            csv_writer.writeheader()
+
+        report_file.write(head)
+        if placeholder:
+            report_file.write("[")
+            separator = ""
+            for row in data:
+                dumped_row = dump_report_row(row)
+                report_file.write(separator)
+                report_file.write(dumped_row)
+                separator = ",\n"
+                if jsonl_file is not None:
+                    jsonl_file.write(dumped_row)
+                    jsonl_file.write("\n")
+                if csv_writer is not None:
+                    csv_writer.writerow(row)
+            report_file.write("]")
+        report_file.write(tail)
+
+    for path in [to] + [sidecars[fmt] for fmt in ("jsonl", "csv") if sidecars.get(fmt)]:
+        os.replace(path + ".tmp", path)
+
 
+def get_sidecar_paths(report_file_path, formats):
+    base_path = os.path.splitext(report_file_path)[0]
+    return {fmt: f"{base_path}.{fmt}" for fmt in formats if fmt in SIDECAR_FORMATS}
+
+
+def write_report(aggregate, report_file_path, config):
+    report_rows = iter_report_rows(
+        aggregate,
+        config['MAX_REPORT_SIZE'],
+        config.get('REPORT_SORT_KEY', DEFAULT_REPORT_SORT_KEY)
+    )
+    sidecars = get_sidecar_paths(report_file_path, config.get('REPORT_FORMATS', []))
+
+    render_template(REPORT_TEMPLATE_PATH, report_file_path, report_rows, sidecars)
+
+    logging.info('Report saved to {}'.format(
+        os.path.normpath(report_file_path)))
 
-def main(config):
+
+def write_daily_report(aggregate, file_date, config):
+    write_report(aggregate, get_report_path(config['REPORTS_DIR'], file_date), config)
+    if config.get('SNAPSHOTS_DIR'):
+        save_snapshot(config['SNAPSHOTS_DIR'], file_date, aggregate)
+
+
+def analyze_backlog(config):
+    files_info = get_log_files_info(config['LOGS_DIR'])
+    if not files_info:
+        logging.info('Ooops. No log files yet')
+        return
+
+    latest_log_info = files_info[-1]
+    any_changed = False
+    for log_info in files_info[-config.get('BACKLOG_SIZE', 1):]:
+        report_file_path = get_report_path(config['REPORTS_DIR'], log_info.file_date)
+        checkpoint_path = get_checkpoint_path(config['CHECKPOINT_DIR'], log_info.file_path)
+        is_complete = log_info is not latest_log_info
+        if is_complete and os.path.isfile(report_file_path) and not os.path.isfile(checkpoint_path):
+            # reported before checkpoints were enabled
+            continue
+
+        aggregate, changed = analyze_log_incrementally(log_info, config, is_complete)
+        if not changed and os.path.isfile(report_file_path):
+            logging.info('Report for "{}" is up-to-date'.format(os.path.normpath(log_info.file_path)))
+            continue
+
+        write_daily_report(aggregate, log_info.file_date, config)
+        any_changed = True
+
+    if config.get('SNAPSHOTS_DIR'):
+        build_rolling_reports(config, force=any_changed)
+
+
+def main(config, config_from_file=None):
     if config_from_file:
         config.update(config_from_file)
     setup_logger(config.get('LOG_FILE'))
 
+    if config.get('REPORT_MODE') == REPORT_MODE_ROLLING:
+        build_rolling_reports(config, force=True)
+        return
+
+    if config.get('CHECKPOINT_DIR'):
+        analyze_backlog(config)
+        return
+
     latest_log_info = get_latest_log_info(config['LOGS_DIR'])
     if not latest_log_info:
         logging.info('Ooops. No log files yet')
         return
 
-    report_date_string = latest_log_info.file_date.strftime("%Y.%m.%d")
-    report_filename = "report-{}.html".format(report_date_string)
-    report_file_path = os.path.join(config['REPORTS_DIR'], report_filename)
+    report_file_path = get_report_path(config['REPORTS_DIR'], latest_log_info.file_date)
 
     if os.path.isfile(report_file_path):
         logging.info("Looks like everything is up-to-date")
@@ -185,30 +1068,42 @@ def main(config):
     # report creation
     logging.info('Collecting data from "{}"'.format(
         os.path.normpath(latest_log_info.file_path)))
-    log_records = get_log_records(
+    aggregate = aggregate_log_file(
         latest_log_info.file_path,
-        parse_log_record,
-        config.get('ERRORS_LIMIT')
+        build_parser(config),
+        config.get('ERRORS_LIMIT'),
+        config.get('MEDIAN_MODE', MEDIAN_MODE_SKETCH),
+        config.get('WORKERS', 1),
+        max_urls=config.get('MAX_TRACKED_URLS'),
+        gzip_reader=config.get('GZIP_READER', GZIP_READER_STREAM)
     )
-    report_data = create_report(log_records, config['MAX_REPORT_SIZE'])
+    write_daily_report(aggregate, latest_log_info.file_date, config)
+    if config.get('SNAPSHOTS_DIR'):
+        build_rolling_reports(config, force=True)
 
-    render_template(REPORT_TEMPLATE_PATH, report_file_path, report_data)
 
-    logging.info('Report saved to {}'.format(
-        os.path.normpath(report_file_path)))
-
-def load_user_config():
-    parser = argparse.ArgumentParser()
+def parse_args():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
     parser.add_argument(
         '--config',
         help='Config file path',
         default=DEFAULT_CONFIG_PATH
     )
-    args = parser.parse_args()
-    
+    parser.add_argument(
+        '--benchmark-parsers',
+        metavar='LOG_PATH',
+        help='Compare log line parsers on a sample of the given log and exit'
+    )
+    return parser.parse_args()
+
+
+def load_user_config(args=None):
+    if args is None:
+        args = parse_args()
+
     if not args.config:
         return
-    
+
     try:
         config = load_conf(args.config)
     except (json.JSONDecodeError, FileNotFoundError):
@@ -218,12 +1113,15 @@ def load_user_config():
 
 
 if __name__ == '__main__':
-    config = load_user_config()
+    args = parse_args()
+    if args.benchmark_parsers:
+        print(json.dumps(benchmark_parsers(args.benchmark_parsers), indent=4))
+        sys.exit()
+
+    config = load_user_config(args)
     setup_logger(config.get('LOG_FILE'))
    
     try:
         main(copy.deepcopy(config))
     except Exception as e:
         logging.exception("Somthing was wrong")
-else:
-    config_from_file = load_user_config()
\ No newline at end of file
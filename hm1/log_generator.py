@@ -0,0 +1,94 @@
+import argparse
+import gzip
+import io
+import random
+from datetime import datetime, timedelta
+
+
+DEFAULT_LINES = 100000
+DEFAULT_URLS = 1000
+URL_TEMPLATES = [
+    "/api/v2/banner/{id}",
+    "/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28",
+    "/api/1/photogenic_banners/list/?server_name=WIN7RB{id}",
+    "/api/v2/internal/banner/{id}/info",
+    "/export/appinstall_raw/2017-06-30/{id}",
+    "/slots/{id}/groups",
+]
+USER_AGENTS = [
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36",
+    "python-requests/2.13.0",
+    "-",
+]
+MALFORMED_LINES = [
+    '1.196.116.32 -  - [29/Jun/2017:03:51:01 +0300] "GET',
+    '"-" "-" "-" 0.390',
+    '\udcff\udcfe broken',
+    '',
+]
+LOG_LINE_FORMAT = (
+    '{remote_addr} -  - [{time_local}] "GET {href} HTTP/1.1" 200 {body_bytes_sent} "-" '
+    '"{user_agent}" "-" "{request_id}" "dc7161be3" {request_time:.3f}\n'
+)
+
+
+def make_urls(count, rnd):
+    return [
+        URL_TEMPLATES[i % len(URL_TEMPLATES)].format(id=rnd.randint(1, 10 ** 8))
+        for i in range(count)
+    ]
+
+
+def generate_log_lines(lines, urls=DEFAULT_URLS, malformed_rate=0.0, seed=None, start=None):
+    rnd = random.Random(seed)
+    url_list = make_urls(urls, rnd)
+    start = start or datetime(2017, 6, 29, 3, 0, 0)
+    for number in range(lines):
+        if malformed_rate and rnd.random() < malformed_rate:
+            yield rnd.choice(MALFORMED_LINES) + "\n"
+            continue
+        # a few hot urls and a long tail, like real traffic
+        href = url_list[int(len(url_list) * rnd.random() ** 3)]
+        time_local = start + timedelta(seconds=number // 100)
+        yield LOG_LINE_FORMAT.format(
+            remote_addr="1.{}.{}.{}".format(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+            time_local=time_local.strftime("%d/%b/%Y:%H:%M:%S +0300"),
+            href=href,
+            body_bytes_sent=rnd.randint(0, 100000),
+            user_agent=rnd.choice(USER_AGENTS),
+            request_id="{}-{}-{}".format(int(time_local.timestamp()), rnd.randint(10 ** 9, 10 ** 10), number),
+            request_time=rnd.lognormvariate(-1.5, 1.0),
+        )
+
+
+def generate_log(path, lines=DEFAULT_LINES, urls=DEFAULT_URLS, compress=None, malformed_rate=0.0, seed=None):
+    if compress is None:
+        compress = path.endswith(".gz")
+    open_fn = gzip.open if compress else io.open
+    with open_fn(path, "wt", encoding="utf-8", errors="surrogateescape") as log_file:
+        log_file.writelines(generate_log_lines(lines, urls, malformed_rate, seed))
+    return path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic ui_short nginx log")
+    parser.add_argument("path", help="Output file, a .gz suffix turns on compression")
+    parser.add_argument("--lines", type=int, default=DEFAULT_LINES)
+    parser.add_argument("--urls", type=int, default=DEFAULT_URLS, help="Number of distinct urls")
+    parser.add_argument("--gzip", action="store_true", help="Compress output regardless of suffix")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Share of broken lines, 0..1")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate_log(
+        args.path,
+        lines=args.lines,
+        urls=args.urls,
+        compress=args.gzip or None,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+    )
@@ -1,5 +1,48 @@
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
-from log_analyzer_reduced import is_gzip_file, parse_log_record
+from unittest import mock
+from datetime import date
+from log_analyzer_reduced import (
+    is_gzip_file, parse_log_record, create_report, aggregate_records,
+    QuantileSketch, MEDIAN_MODE_EXACT, split_file_ranges, aggregate_log_file,
+    build_report, analyze_backlog, load_checkpoint, get_checkpoint_path, LogAggregate,
+    UrlNormalizer, build_parser, OTHER_URL, LOG_PARSERS, parse_log_record_strict,
+    benchmark_parsers, render_template, REPORT_TEMPLATE_PATH, get_sidecar_paths,
+    read_gzip_blocks, DecompressStats, GZIP_READERS, save_snapshot, build_rolling_reports,
+    get_snapshots_info, merge_snapshots, GZIP_READER_PIPE, get_gzip_pipe_command
+)
+from log_generator import generate_log
+from benchmark import run_phases
+
+
+LOG_LINE = (
+    '1.196.116.32 -  - [29/Jun/2017:03:51:01 +0300] "GET {href} HTTP/1.1" 200 948 "-" '
+    '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+    '"1498697460-2190034393-4708-9753194" "dc7161be3" {time}\n'
+)
+
+
+def make_log_lines(count):
+    return [
+        LOG_LINE.format(href=f"/api/v2/banner/{i % 7}", time=f"{(i % 13) / 10 + 0.001:.3f}")
+        for i in range(count)
+    ]
+
+
+def write_test_logs(dir_path, lines):
+    # the same lines as a plain and as a gzipped log
+    plain_path = os.path.join(dir_path, "nginx-access-ui.log-20170630")
+    with open(plain_path, "w") as log_file:
+        log_file.writelines(lines)
+    gzip_path = plain_path + ".gz"
+    with gzip.open(gzip_path, "wt") as log_file:
+        log_file.writelines(lines)
+    return plain_path, gzip_path
 
 
 class TestIsGzipFileFunction(unittest.TestCase):
@@ -19,6 +62,376 @@ class TestParseRecord(unittest.TestCase):
         self.assertEqual(parse_log_record(
             str), ("/api/v2/banner/1662508", "0.689\n"))
 
+    def test_parsers_agree(self):
+        for log_line in make_log_lines(20):
+            log_line = log_line.encode()
+            expected_href, expected_time = parse_log_record(log_line)
+            for name, parser in LOG_PARSERS.items():
+                href, request_time = parser(log_line)
+                self.assertEqual(href, expected_href, name)
+                self.assertEqual(float(request_time), float(expected_time), name)
+
+    def test_strict_parser_rejects_malformed_line(self):
+        with self.assertRaises(ValueError):
+            parse_log_record_strict(b'1.196.116.32 - "GET /api/v2/banner/1 HTTP/1.1" 0.689\n')
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_median_within_relative_accuracy(self):
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for value in range(1, 1002):
+            sketch.add(value / 1000)
+        self.assertAlmostEqual(sketch.quantile(0.5), 0.501, delta=0.501 * 0.01)
+
+    def test_merge(self):
+        left, right, whole = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for value in range(1, 101):
+            (left if value % 2 else right).add(value / 10)
+            whole.add(value / 10)
+        left.merge(right)
+        self.assertEqual(left.count, whole.count)
+        self.assertEqual(left.quantile(0.5), whole.quantile(0.5))
+
+    def test_bins_bounded(self):
+        sketch = QuantileSketch()
+        for _ in range(10000):
+            sketch.add(0.5)
+        self.assertEqual(len(sketch.bins), 1)
+
+
+class TestCreateReport(unittest.TestCase):
+    records = [
+        ("/a", "0.1"), ("/b", "1.0"), ("/a", "0.3"), ("/a", "0.2"), ("/b", "3.0"),
+    ]
+
+    def test_create_report_exact(self):
+        report = {row["url"]: row for row in create_report(self.records, 10, MEDIAN_MODE_EXACT)}
+        self.assertEqual(report["/a"]["count"], 3)
+        self.assertAlmostEqual(report["/a"]["time_sum"], 0.6)
+        self.assertAlmostEqual(report["/a"]["time_med"], 0.2)
+        self.assertAlmostEqual(report["/b"]["time_max"], 3.0)
+        self.assertAlmostEqual(report["/b"]["time_med"], 2.0)
+        self.assertAlmostEqual(report["/b"]["count_perc"], 40.0)
+
+    def test_create_report_consumes_iterator(self):
+        aggregate = aggregate_records(iter(self.records))
+        self.assertEqual(aggregate.total_records, 5)
+        self.assertEqual(len(aggregate.urls), 2)
+        self.assertAlmostEqual(aggregate.urls["/a"].times.quantile(0.5), 0.2, delta=0.002)
+
+    def test_create_report_keeps_most_expensive(self):
+        records = [("/cheap", "0.1")] * 5 + [("/expensive", "10.0")] + [("/middle", "1.0")] * 2
+        report = create_report(records, 2)
+        self.assertEqual([row["url"] for row in report], ["/expensive", "/middle"])
+
+    def test_create_report_sort_key(self):
+        records = [("/cheap", "0.1")] * 5 + [("/expensive", "10.0")]
+        report = create_report(records, 1, sort_key="count")
+        self.assertEqual(report[0]["url"], "/cheap")
+        with self.assertRaises(ValueError):
+            create_report(records, 1, sort_key="unknown")
+
+
+class TestParallelAggregation(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.lines = make_log_lines(500)
+        self.plain_path, self.gzip_path = write_test_logs(self.tmp_dir.name, self.lines)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_split_file_ranges_aligned_to_lines(self):
+        ranges = split_file_ranges(self.plain_path, 7)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.plain_path))
+        with open(self.plain_path, "rb") as log_file:
+            data = log_file.read()
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+            self.assertEqual(data[end - 1:end], b"\n")
+
+    def test_parallel_matches_serial(self):
+        serial = build_report(aggregate_log_file(self.plain_path, parse_log_record), 100)
+        for path in (self.plain_path, self.gzip_path):
+            parallel = build_report(aggregate_log_file(path, parse_log_record, workers=2), 100)
+            self.assertEqual(
+                sorted((row["url"], row["count"], round(row["time_sum"], 6)) for row in parallel),
+                sorted((row["url"], row["count"], round(row["time_sum"], 6)) for row in serial)
+            )
+
+    def test_carriage_return_does_not_split_lines(self):
+        with open(self.plain_path, "ab") as log_file:
+            log_file.write(LOG_LINE.format(href="/a\rb", time="0.5").replace("Lynx", "Lynx\r\x0c").encode())
+        parser = LOG_PARSERS["bytes"]
+        serial = aggregate_log_file(self.plain_path, parser)
+        self.assertEqual((serial.total_records, serial.errors), (501, 0))
+        with gzip.open(self.gzip_path, "wb") as log_file, open(self.plain_path, "rb") as plain_file:
+            log_file.write(plain_file.read())
+        for reader in GZIP_READERS:
+            for workers in (1, 2):
+                aggregate = aggregate_log_file(self.gzip_path, parser, workers=workers, gzip_reader=reader)
+                self.assertEqual((aggregate.total_records, aggregate.errors), (501, 0), (reader, workers))
+
+
+class TestGzipReaders(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.lines = make_log_lines(500)
+        _, self.gzip_path = write_test_logs(self.tmp_dir.name, self.lines)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_gzip_readers(self):
+        for reader in GZIP_READERS:
+            aggregate = aggregate_log_file(self.gzip_path, parse_log_record, gzip_reader=reader)
+            self.assertEqual(aggregate.total_records, 500, reader)
+
+    def test_read_gzip_blocks(self):
+        stats = DecompressStats()
+        blocks = list(read_gzip_blocks(self.gzip_path, block_size=1000, stats=stats))
+        self.assertGreater(len(blocks), 1)
+        self.assertTrue(all(block.endswith(b"\n") for block in blocks))
+        self.assertEqual(b"".join(blocks), "".join(self.lines).encode())
+        self.assertEqual(stats.bytes, len(b"".join(blocks)))
+
+    def test_truncated_gzip_in_pipe_mode(self):
+        if get_gzip_pipe_command(self.gzip_path) is None:
+            self.skipTest("no external gzip decompressor")
+        with open(self.gzip_path, "r+b") as log_file:
+            log_file.truncate(os.path.getsize(self.gzip_path) // 2)
+        with self.assertRaises(RuntimeError):
+            list(read_gzip_blocks(self.gzip_path, reader=GZIP_READER_PIPE))
+
+    def test_pipe_exit_code_checked_after_eof(self):
+        # the decompressor fails only after it has written all the data
+        command = ["sh", "-c", 'gzip -dc "$0" && sleep 0.2 && exit 3']
+        if not (shutil.which("sh") and shutil.which("gzip")):
+            self.skipTest("no sh or gzip")
+        with mock.patch("log_analyzer_reduced.GZIP_PIPE_COMMANDS", [command]):
+            with self.assertRaises(RuntimeError):
+                list(read_gzip_blocks(self.gzip_path, reader=GZIP_READER_PIPE))
+
+    def test_pipe_stopped_early(self):
+        blocks = read_gzip_blocks(self.gzip_path, block_size=1000, reader=GZIP_READER_PIPE)
+        self.assertTrue(next(blocks).endswith(b"\n"))
+        blocks.close()
+
+
+class TestLogParsers(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.plain_path, _ = write_test_logs(self.tmp_dir.name, make_log_lines(500))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_malformed_lines_count_as_errors(self):
+        with open(self.plain_path, "a") as log_file:
+            log_file.write("garbage\n" * 10)
+        aggregate = aggregate_log_file(self.plain_path, parse_log_record_strict)
+        self.assertEqual(aggregate.total_records, 500)
+        self.assertEqual(aggregate.errors, 10)
+        with self.assertRaises(RuntimeError):
+            aggregate_log_file(self.plain_path, parse_log_record_strict, errors_limit=0.01)
+
+    def test_benchmark_parsers(self):
+        results = benchmark_parsers(self.plain_path, limit=100, repeat=1)
+        self.assertEqual(results["lines"], 100)
+        for name in list(LOG_PARSERS) + ["noop"]:
+            self.assertEqual(results[name]["errors"], 0)
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_generated_log(self):
+        log_path = generate_log(
+            os.path.join(self.tmp_dir.name, "generated.log.gz"), lines=1000, urls=50, malformed_rate=0.1, seed=1
+        )
+        aggregate = aggregate_log_file(log_path, parse_log_record)
+        self.assertEqual(aggregate.total_records + aggregate.errors, 1000)
+        self.assertGreater(aggregate.errors, 50)
+        self.assertLessEqual(len(aggregate.urls), 50)
+
+    def test_phases_count_last_unterminated_line(self):
+        log_path = os.path.join(self.tmp_dir.name, "nginx-access-ui.log-20170630")
+        with open(log_path, "w") as f:
+            f.write("".join(make_log_lines(10)).rstrip("\n"))
+        timings, counters, distinct_urls = run_phases(
+            log_path, {}, os.path.join(self.tmp_dir.name, "report.html")
+        )
+        self.assertEqual(counters["lines"], 10)
+        self.assertEqual(counters["errors"], 0)
+        self.assertEqual(distinct_urls, 7)
+
+
+class TestUrlNormalization(unittest.TestCase):
+    def test_default_rules(self):
+        normalize = UrlNormalizer()
+        self.assertEqual(normalize("/api/v2/banner/1662508"), "/api/v2/banner/{id}")
+        self.assertEqual(normalize("/api/v2/banner/23815685?x=1"), "/api/v2/banner/{id}")
+        self.assertEqual(
+            normalize("/api/1/photogenic_banners/list/?server_name=WIN7RB4"),
+            "/api/{id}/photogenic_banners/list/"
+        )
+        self.assertEqual(
+            normalize("/export/appinstall_raw/2017-06-30/e1a26b7e-5f32-4b7c-9c0f-4f9a6c1b2d3e"),
+            "/export/appinstall_raw/2017-06-30/{uuid}"
+        )
+        self.assertEqual(normalize("/slots/3c4d5e6f7a8b9c0d1e2f/groups"), "/slots/{hex}/groups")
+        self.assertEqual(normalize("/api/v2/banner"), "/api/v2/banner")
+
+    def test_keep_query_and_custom_rules(self):
+        normalize = UrlNormalizer(rules=[[r"banner/\d+", "banner/N"]], strip_query=False)
+        self.assertEqual(normalize("/banner/12?a=1"), "/banner/N?a=1")
+
+    def test_normalizing_parser(self):
+        parser = build_parser({"URL_NORMALIZATION": True})
+        line = make_log_lines(2)[1].encode()
+        self.assertEqual(parser(line)[0], "/api/v2/banner/{id}")
+
+    def test_max_tracked_urls(self):
+        records = [(f"/url/{i}", "1.0") for i in range(10)]
+        aggregate = aggregate_records(records, max_urls=3)
+        self.assertEqual(len(aggregate.urls), 4)
+        self.assertEqual(aggregate.urls[OTHER_URL].count, 7)
+        self.assertEqual(aggregate.total_records, 10)
+
+        merged = LogAggregate(max_urls=3)
+        merged.merge(aggregate)
+        self.assertEqual(merged.urls[OTHER_URL].count, 7)
+
+
+class TestRenderTemplate(unittest.TestCase):
+    rows = [
+        {"url": "/a</script>", "count": 2, "count_perc": 50.0, "time_sum": 1.5, "time_perc": 75.0,
+         "time_avg": 0.75, "time_max": 1.0, "time_med": 0.75},
+        {"url": "/b", "count": 2, "count_perc": 50.0, "time_sum": 0.5, "time_perc": 25.0,
+         "time_avg": 0.25, "time_max": 0.3, "time_med": 0.25},
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.report_path = os.path.join(self.tmp_dir.name, "report-2017.06.30.html")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_render_json_and_sidecars(self):
+        sidecars = get_sidecar_paths(self.report_path, ["html", "jsonl", "csv"])
+        render_template(REPORT_TEMPLATE_PATH, self.report_path, iter(self.rows), sidecars)
+
+        with open(self.report_path) as report_file:
+            report = report_file.read()
+        table_json = report.split("var table = ", 1)[1].split(";\n", 1)[0]
+        self.assertNotIn("</script>", table_json)
+        self.assertEqual(json.loads(table_json), self.rows)
+
+        with open(sidecars["jsonl"]) as jsonl_file:
+            self.assertEqual([json.loads(line) for line in jsonl_file], self.rows)
+        with open(sidecars["csv"], newline="") as csv_file:
+            csv_rows = list(csv.DictReader(csv_file))
+        self.assertEqual([row["url"] for row in csv_rows], ["/a</script>", "/b"])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), [
+            "report-2017.06.30.csv", "report-2017.06.30.html", "report-2017.06.30.jsonl"
+        ])
+
+    def test_render_empty_report(self):
+        render_template(REPORT_TEMPLATE_PATH, self.report_path, None)
+        with open(self.report_path) as report_file:
+            self.assertIn("var table = [];", report_file.read())
+
+
+class TestIncrementalAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = {
+            "LOGS_DIR": os.path.join(self.tmp_dir.name, "logs"),
+            "REPORTS_DIR": os.path.join(self.tmp_dir.name, "reports"),
+            "CHECKPOINT_DIR": os.path.join(self.tmp_dir.name, "checkpoints"),
+            "MAX_REPORT_SIZE": 10,
+            "BACKLOG_SIZE": 7,
+            "SNAPSHOTS_DIR": os.path.join(self.tmp_dir.name, "snapshots"),
+            "ROLLING_WINDOWS": [2, 30],
+        }
+        os.makedirs(self.config["LOGS_DIR"])
+        os.makedirs(self.config["REPORTS_DIR"])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def load_aggregate(self, log_path):
+        checkpoint = load_checkpoint(get_checkpoint_path(self.config["CHECKPOINT_DIR"], log_path))
+        return checkpoint, LogAggregate.from_dict(checkpoint["aggregate"])
+
+    def test_resume_growing_log(self):
+        log_path = os.path.join(self.config["LOGS_DIR"], "nginx-access-ui.log-20170630")
+        lines = make_log_lines(150)
+        with open(log_path, "w") as log_file:
+            log_file.writelines(lines[:100])
+            log_file.write(lines[100][:20])
+        analyze_backlog(self.config)
+        checkpoint, aggregate = self.load_aggregate(log_path)
+        self.assertEqual(aggregate.total_records, 100)
+        self.assertFalse(checkpoint["completed"])
+        self.assertTrue(os.path.isfile(os.path.join(self.config["REPORTS_DIR"], "report-2017.06.30.html")))
+
+        with open(log_path, "a") as log_file:
+            log_file.write(lines[100][20:])
+            log_file.writelines(lines[101:])
+        analyze_backlog(self.config)
+        checkpoint, aggregate = self.load_aggregate(log_path)
+        self.assertEqual(aggregate.total_records, 150)
+        self.assertEqual(checkpoint["offset"], os.path.getsize(log_path))
+
+    def test_backlog_of_dated_files(self):
+        first_path = os.path.join(self.config["LOGS_DIR"], "nginx-access-ui.log-20170629.gz")
+        with gzip.open(first_path, "wt") as log_file:
+            log_file.writelines(make_log_lines(30))
+        second_path = os.path.join(self.config["LOGS_DIR"], "nginx-access-ui.log-20170630")
+        with open(second_path, "w") as log_file:
+            log_file.writelines(make_log_lines(20))
+
+        analyze_backlog(self.config)
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.config["REPORTS_DIR"]) if "rolling" not in name),
+            ["report-2017.06.29.html", "report-2017.06.30.html"]
+        )
+        checkpoint, aggregate = self.load_aggregate(first_path)
+        self.assertTrue(checkpoint["completed"])
+        self.assertEqual(aggregate.total_records, 30)
+
+    def test_rolling_reports_from_snapshots(self):
+        for day, count in ((28, 5), (29, 7), (30, 11)):
+            save_snapshot(self.config["SNAPSHOTS_DIR"], date(2017, 6, day), aggregate_records(
+                [("/api/v2/banner/1", "0.5")] * count + [(f"/day/{day}", "1.0")]
+            ))
+        snapshots_info = get_snapshots_info(self.config["SNAPSHOTS_DIR"])
+        self.assertEqual([info.file_date.day for info in snapshots_info], [28, 29, 30])
+
+        merged = merge_snapshots(snapshots_info[-2:])
+        self.assertEqual(merged.urls["/api/v2/banner/1"].count, 18)
+        self.assertEqual(merged.total_records, 20)
+
+        build_rolling_reports(self.config)
+        self.assertEqual(sorted(os.listdir(self.config["REPORTS_DIR"])), [
+            "report-rolling-2d-2017.06.30.html", "report-rolling-30d-2017.06.30.html"
+        ])
+
+    def test_backlog_writes_snapshots(self):
+        log_path = os.path.join(self.config["LOGS_DIR"], "nginx-access-ui.log-20170630")
+        with open(log_path, "w") as log_file:
+            log_file.writelines(make_log_lines(20))
+        analyze_backlog(self.config)
+        self.assertEqual(os.listdir(self.config["SNAPSHOTS_DIR"]), ["snapshot-20170630.json.gz"])
+        self.assertIn("report-rolling-2d-2017.06.30.html", os.listdir(self.config["REPORTS_DIR"]))
+
 
 if __name__ == '__main__':
     unittest.main()
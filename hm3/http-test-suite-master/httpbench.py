@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# Load generator for httpd.py: starts the server in the given engine/worker
+# configuration, hits it from several client processes and prints req/s and
+# the latency distribution as JSON.
+#
+#   python httpbench.py -e epoll -w 2 -c 100 -d 10 --keepalive --mix page
+#   python httpbench.py --external --port 80 -c 50 --path /httptest/dir2/
+
+from optparse import OptionParser
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+HTTPD_PATH = os.path.join(BENCH_DIR, os.pardir, "httpd.py")
+RECV_SIZE = 64 * 1024
+SERVER_START_TIMEOUT = 5
+CONNECT_TIMEOUT = 10
+PERCENTILES = [50, 90, 99]
+
+
+def get_mixes():
+    page_files = sorted(os.listdir(os.path.join(BENCH_DIR, "httptest", "wikipedia_russia_files")))
+    page = ["/httptest/wikipedia_russia.html"] + [
+        "/httptest/wikipedia_russia_files/" + urllib.parse.quote(name) for name in page_files
+    ]
+    return {
+        "small": ["/httptest/dir2/"],
+        "page": page,
+        "large": ["/httptest/160313.jpg"],
+        "static": [
+            "/httptest/dir2/page.html",
+            "/httptest/splash.css",
+            "/httptest/jquery-1.9.1.js",
+            "/httptest/logo.v2.png",
+            "/httptest/160313.jpg",
+        ],
+    }
+
+
+class Client:
+    # A minimal HTTP/1.1 client, http.client is slow enough to be the
+    # bottleneck of the benchmark
+    def __init__(self, host, port, keepalive):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.sock = None
+        self.buffer = b''
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def recv(self):
+        part = self.sock.recv(RECV_SIZE)
+        if not part:
+            raise ConnectionError("connection closed by the server")
+        return part
+
+    def get(self, path):
+        # (status, bytes received)
+        if self.sock is None:
+            self.connect()
+        connection = "keep-alive" if self.keepalive else "close"
+        self.sock.sendall(
+            ("GET %s HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n\r\n" % (path, self.host, connection)).encode()
+        )
+
+        while b'\r\n\r\n' not in self.buffer:
+            self.buffer += self.recv()
+        head, _, body = self.buffer.partition(b'\r\n\r\n')
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        # the body is only counted, not kept
+        length = int(headers.get("content-length", 0))
+        remaining = length - len(body)
+        self.buffer = body[length:]
+        while remaining > 0:
+            part = self.recv()
+            if len(part) > remaining:
+                self.buffer = part[remaining:]
+            remaining -= len(part)
+        received = len(head) + 4 + length
+
+        if not self.keepalive or headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, received
+
+
+def run_thread(options, paths, offset, deadline, quota, result, lock):
+    client = Client(options.host, options.port, options.keepalive)
+    latencies = []
+    statuses = {}
+    errors = 0
+    received = 0
+    sent = 0
+    for path in itertools.islice(itertools.cycle(paths), offset, None):
+        if time.monotonic() >= deadline or (quota is not None and sent >= quota):
+            break
+        sent += 1
+        started = time.perf_counter()
+        try:
+            status, size = client.get(path)
+        except (OSError, ValueError, IndexError):
+            errors += 1
+            client.close()
+            continue
+        latencies.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+        received += size
+    client.close()
+
+    with lock:
+        result["latencies"].extend(latencies)
+        result["errors"] += errors
+        result["bytes"] += received
+        for status, count in statuses.items():
+            result["statuses"][status] = result["statuses"].get(status, 0) + count
+
+
+def run_client_process(options, paths, threads, first_offset, deadline_in, quota):
+    # runs in a separate process, so the GIL of one client does not limit the load
+    deadline = time.monotonic() + deadline_in
+    result = {"latencies": [], "errors": 0, "bytes": 0, "statuses": {}}
+    lock = threading.Lock()
+    workers = [
+        threading.Thread(
+            target=run_thread,
+            args=(options, paths, first_offset + number, deadline, quota, result, lock)
+        )
+        for number in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return result
+
+
+def split_evenly(total, parts):
+    return [total // parts + (1 if number < total % parts else 0) for number in range(parts)]
+
+
+def run_load(options, paths):
+    processes = max(1, min(options.client_processes, options.concurrency))
+    threads = split_evenly(options.concurrency, processes)
+    duration = options.duration if options.requests is None else float("inf")
+    quota = None
+    if options.requests is not None:
+        quota = -(-options.requests // options.concurrency)
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [
+            executor.submit(run_client_process, options, paths, count, sum(threads[:number]), duration, quota)
+            for number, count in enumerate(threads)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    total = {"latencies": [], "errors": 0, "bytes": 0, "statuses": {}}
+    for result in results:
+        total["latencies"].extend(result["latencies"])
+        total["errors"] += result["errors"]
+        total["bytes"] += result["bytes"]
+        for status, count in result["statuses"].items():
+            total["statuses"][status] = total["statuses"].get(status, 0) + count
+    return total, elapsed
+
+
+def get_percentile(sorted_values, percent):
+    # nearest rank
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(total, elapsed):
+    latencies = sorted(total["latencies"])
+    completed = len(latencies)
+    latency = {
+        "min": latencies[0] * 1000 if latencies else None,
+        "mean": sum(latencies) / completed * 1000 if latencies else None,
+        "max": latencies[-1] * 1000 if latencies else None,
+    }
+    for percent in PERCENTILES:
+        value = get_percentile(latencies, percent)
+        latency["p%d" % percent] = value * 1000 if value is not None else None
+
+    return {
+        "requests": completed,
+        "errors": total["errors"],
+        "statuses": {str(status): count for status, count in sorted(total["statuses"].items())},
+        "seconds": elapsed,
+        "requests_per_sec": completed / elapsed if elapsed else None,
+        "mb_per_sec": total["bytes"] / 1024 / 1024 / elapsed if elapsed else None,
+        "latency_ms": latency,
+    }
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def start_server(options):
+    command = [
+        sys.executable, HTTPD_PATH,
+        "--host", options.host,
+        "-p", str(options.port),
+        "-r", BENCH_DIR,
+        "-e", options.engine,
+        "-w", str(options.workers),
+        "-P", str(options.processes),
+    ]
+    if options.reuseport:
+        command.append("--reuseport")
+    command.extend(options.server_args)
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port(options.host, options.port, SERVER_START_TIMEOUT):
+        server.kill()
+        raise RuntimeError("server did not start: %s" % " ".join(command))
+    return server
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def warm_up(options, paths):
+    # one request per file fills the server caches before anything is measured
+    client = Client(options.host, options.port, keepalive=False)
+    for path in paths:
+        try:
+            client.get(path)
+        except (OSError, ValueError, IndexError):
+            client.close()
+
+
+def get_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=BENCH_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(options):
+    paths = options.paths or get_mixes()[options.mix]
+    server = None if options.external else start_server(options)
+    try:
+        warm_up(options, paths)
+        total, elapsed = run_load(options, paths)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    result = {
+        "version": get_version(),
+        "python": platform.python_version(),
+        "server": {"host": options.host, "port": options.port, "external": options.external},
+        "client": {
+            "concurrency": options.concurrency,
+            "client_processes": options.client_processes,
+            "keepalive": options.keepalive,
+            "duration": options.duration if options.requests is None else None,
+            "requests": options.requests,
+            "paths": len(paths),
+            "mix": None if options.paths else options.mix,
+        },
+    }
+    if not options.external:
+        result["server"].update({
+            "engine": options.engine,
+            "workers": options.workers,
+            "processes": options.processes,
+            "reuseport": options.reuseport,
+            "args": options.server_args,
+        })
+    result.update(summarize(total, elapsed))
+
+    output = json.dumps(result, indent=4)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [-- httpd options]")
+    op.add_option("--host", action="store", type=str, default="localhost")
+    op.add_option("-p", "--port", action="store", type=int, default=8090)
+    op.add_option("--external", action="store_true", default=False,
+                  help="benchmark a server that is already running on --host/--port")
+    op.add_option("-e", "--engine", action="store", type=str, default="thread")
+    op.add_option("-w", "--workers", action="store", type=int, default=2)
+    op.add_option("-P", "--processes", action="store", type=int, default=0)
+    op.add_option("--reuseport", action="store_true", default=False)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=50,
+                  help="connections open at the same time")
+    op.add_option("--client-processes", action="store", type=int, default=min(os.cpu_count() or 1, 4),
+                  help="processes the client connections are spread over")
+    op.add_option("-d", "--duration", action="store", type=float, default=10,
+                  help="seconds to run, ignored with --requests")
+    op.add_option("-n", "--requests", action="store", type=int, default=None,
+                  help="total number of requests instead of a duration")
+    op.add_option("-k", "--keepalive", action="store_true", default=False,
+                  help="reuse connections instead of opening one per request")
+    op.add_option("-m", "--mix", action="store", type="choice", choices=sorted(get_mixes()), default="small",
+                  help="set of files to request: small, page, large or static")
+    op.add_option("--path", action="append", dest="paths", default=[],
+                  help="url to request instead of a mix, may be repeated")
+    op.add_option("-o", "--output", action="store", default=None, help="also write the JSON result here")
+    (opts, args) = op.parse_args()
+    opts.server_args = args
+    main(opts)
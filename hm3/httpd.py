@@ -1,19 +1,35 @@
 from optparse import OptionParser
+from bisect import bisect_left
+import asyncio
+import gzip
 import logging
+import selectors
 import socket
 import string
 import random
+import re
+import signal
 import threading
+import time
 import urllib.parse
 import os
-from datetime import datetime, timezone
+import stat
+from collections import OrderedDict, deque
+from email.utils import formatdate, parsedate_to_datetime
 import mimetypes
 
 OK = 200
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
 NOT_FOUND = 404
 FORBIDDEN = 403
 BAD_REQUEST = 400
 NOT_ALLOWED = 405
+RANGE_NOT_SATISFIABLE = 416
+REQUEST_HEADER_FIELDS_TOO_LARGE = 431
+# guess_type() loads the system mime.types on first use, which can change the
+# defaults (e.g. .js becomes text/javascript), so load it before building the lists
+mimetypes.init()
 ALLOWED_CONTENT_TYPE = [
     mimetypes.types_map['.html'],
     mimetypes.types_map['.css'],
@@ -23,89 +39,842 @@ ALLOWED_CONTENT_TYPE = [
     mimetypes.types_map['.png'],
     mimetypes.types_map['.gif'],
     mimetypes.types_map['.swf'],
+    # precompressed siblings like style.css.gz requested by their own name
+    'application/gzip',
 ]
+COMPRESSIBLE_CONTENT_TYPE = [
+    mimetypes.types_map['.html'],
+    mimetypes.types_map['.css'],
+    mimetypes.types_map['.js'],
+]
+ENGINE_THREAD = "thread"
+ENGINE_EPOLL = "epoll"
+ENGINE_ASYNCIO = "asyncio"
+ENGINES = [ENGINE_THREAD, ENGINE_EPOLL, ENGINE_ASYNCIO]
+RECV_SIZE = 64 * 1024
+SELECT_TIMEOUT = 1
+KEEPALIVE_TIMEOUT = 5
+KEEPALIVE_REQUESTS = 100
+# a client has this long to send a whole request head once it started it
+REQUEST_TIMEOUT = 10
+MAX_HEADER_SIZE = 16 * 1024
+LISTEN_BACKLOG = 1024
+# smaller bodies are sent together with the headers in one write, bigger
+# files are streamed from the page cache with sendfile
+SENDFILE_MIN_SIZE = 16 * 1024
+SEND_CHUNK_SIZE = 64 * 1024
+USE_SENDFILE = hasattr(os, "sendfile")
+# asyncio engine: a write waits for a slow client once this much is buffered
+WRITE_BUFFER_HIGH = 256 * 1024
+CACHE_SIZE = 64 * 1024 * 1024
+CACHE_MAX_FILE_SIZE = 1024 * 1024
+CACHE_CHECK_INTERVAL = 1
+# what a cache entry without a body is charged: the key and the entry object,
+# so these count against the budget and age out like the others
+MARKER_ENTRY_SIZE = 256
+PATH_CACHE_TTL = 1
+PATH_CACHE_ENTRIES = 10000
+GZIP_CACHE_SIZE = 16 * 1024 * 1024
+GZIP_MAX_FILE_SIZE = 4 * 1024 * 1024
+# smaller files do not get shorter enough to be worth it
+GZIP_MIN_SIZE = 256
+GZIP_LEVEL = 6
+STATUS_PATH = "/server-status"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# upper bounds in seconds of the response time histogram
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+# more ranges than this in one request are ignored and the whole file is sent
+MAX_RANGES = 16
+# ascii digits only, str.isdigit() takes superscripts that int() refuses
+RANGE_SPEC_RE = re.compile(r'([0-9]*)-([0-9]*)')
+CHILD_CHECK_INTERVAL = 1
+RESTART_MIN_UPTIME = 1
+RESTART_DELAY = 1
+# on SIGTERM open connections get this long to finish before they are dropped
+DRAIN_TIMEOUT = 10
+# taken by the supervisor with sigwait, never by worker threads
+SUPERVISOR_SIGNALS = {signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+# macOS has no sigtimedwait, there a SIGALRM timer ends the sigwait instead
+HAS_SIGTIMEDWAIT = hasattr(signal, "sigtimedwait")
 MAP_STATUS_TO_TEXT = {
     OK: "OK",
+    PARTIAL_CONTENT: "Partial Content",
+    NOT_MODIFIED: "Not Modified",
     NOT_FOUND: "Not Found",
     FORBIDDEN: "Forbidden",
     BAD_REQUEST: "Bad Request",
-    NOT_ALLOWED: "Not Allowed"
+    NOT_ALLOWED: "Not Allowed",
+    RANGE_NOT_SATISFIABLE: "Range Not Satisfiable",
+    REQUEST_HEADER_FIELDS_TOO_LARGE: "Request Header Fields Too Large"
+}
+# the server always answers as HTTP/1.1, clients of both versions understand it
+STATUS_LINES = {
+    status: ("HTTP/1.1 %d %s\r\n" % (status, text)).encode("ascii")
+    for status, text in MAP_STATUS_TO_TEXT.items()
 }
+SERVER_HEADER = b"Server: OTUS\r\n"
+CONNECTION_HEADERS = {
+    True: b"Connection: keep-alive\r\n",
+    False: b"Connection: close\r\n",
+}
+# the only request headers the server looks at, the rest are never decoded
+REQUEST_HEADERS = {
+    b"connection": "connection",
+    b"range": "range",
+    b"if-range": "if-range",
+    b"if-none-match": "if-none-match",
+    b"if-modified-since": "if-modified-since",
+    b"accept-encoding": "accept-encoding",
+}
+
+
+class FileBody:
+    # A region of an open file, sent without copying it into python. Without
+    # os.sendfile the file goes out in SEND_CHUNK_SIZE pieces through one
+    # reused buffer, so memory per request does not depend on the file size.
+    # Parts of a multipart response share one file, only the last one owns it.
+    def __init__(self, file, offset, count, owns_file=True):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.owns_file = owns_file
+        self.buffer = None
+        self.pending = None
+
+    def send(self, sock):
+        # one non-blocking write, returns the number of bytes sent
+        if USE_SENDFILE:
+            sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.count)
+            if not sent:
+                raise OSError("%s is shorter than announced" % self.file.name)
+            self.offset += sent
+            self.count -= sent
+            return sent
+
+        if not self.pending:
+            if self.buffer is None:
+                self.buffer = bytearray(min(self.count, SEND_CHUNK_SIZE))
+            self.file.seek(self.offset)
+            size = self.file.readinto(self.buffer)
+            if not size:
+                raise OSError("%s is shorter than announced" % self.file.name)
+            self.pending = memoryview(self.buffer)[:min(size, self.count)]
+            self.offset += len(self.pending)
+        sent = sock.send(self.pending)
+        self.pending = self.pending[sent:]
+        self.count -= sent
+        return sent
+
+    def send_all(self, sock):
+        # blocking sockets: socket.sendfile waits for the socket itself and
+        # falls back to plain sends where sendfile is not available
+        sock.sendfile(self.file, self.offset, self.count)
+        self.offset += self.count
+        self.count = 0
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+
+
+def join_segments(segments):
+    # small byte strings are merged to go out in one write, big bodies and
+    # file regions are kept as they are to avoid copying them
+    joined = []
+    pending = []
+    for segment in segments:
+        if isinstance(segment, FileBody) or len(segment) >= SENDFILE_MIN_SIZE:
+            if pending:
+                joined.append(b''.join(pending))
+                pending = []
+            joined.append(segment)
+        else:
+            pending.append(segment)
+    if pending:
+        joined.append(b''.join(pending))
+    return joined
+
+
+def close_segments(segments):
+    for segment in segments:
+        if isinstance(segment, FileBody):
+            segment.close()
+
+
+def parse_range(header, size):
+    # list of inclusive (first, last) byte positions, an empty list when none of
+    # them is satisfiable and None when the header has to be ignored
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        match = RANGE_SPEC_RE.fullmatch(spec.strip())
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first:
+            if last and int(last) < int(first):
+                return None
+            first = int(first)
+            last = int(last) if last else size - 1
+            if first < size:
+                ranges.append((first, min(last, size - 1)))
+        elif last:
+            if int(last):
+                ranges.append((max(size - int(last), 0), size - 1))
+        else:
+            return None
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def get_content_type(path):
+    content_type, encoding = mimetypes.guess_type(path.split("/")[-1])
+    if encoding is not None:
+        # style.css.gz is guessed as text/css, but the bytes are gzip and are
+        # sent without Content-Encoding, so it is a gzip download
+        return 'application/gzip' if encoding == 'gzip' else None
+    return content_type
+
+
+def get_file_headers(content_type, file_stat):
+    headers = {
+        'Content-Type': content_type,
+        'Content-Length': str(file_stat.st_size),
+        'Last-Modified': formatdate(file_stat.st_mtime, usegmt=True),
+        # the same mtime-size etag nginx builds, so it stays stable across restarts
+        'ETag': '"%x-%x"' % (file_stat.st_mtime_ns, file_stat.st_size),
+        'Accept-Ranges': 'bytes',
+    }
+    if content_type in COMPRESSIBLE_CONTENT_TYPE:
+        headers['Vary'] = 'Accept-Encoding'
+    return headers
+
+
+def encode_headers(headers):
+    return "".join("%s: %s\r\n" % item for item in headers.items()).encode("latin-1")
+
+
+class DateHeader:
+    # IMF-fixdate, formatted once a second instead of on every response
+    def __init__(self):
+        self.second = None
+        self.value = b''
+
+    def get(self):
+        now = int(time.time())
+        if now != self.second:
+            # value first, a thread that sees the new second also sees its value
+            self.value = ("Date: %s\r\n" % formatdate(now, usegmt=True)).encode("ascii")
+            self.second = now
+        return self.value
+
+
+DATE_HEADER = DateHeader()
+
+
+class CachedFile:
+    def __init__(self, size, mtime, headers, body):
+        self.size = size
+        self.mtime = mtime
+        self.headers = headers
+        # the same headers as bytes, sent as they are for plain 200 responses
+        self.header_block = encode_headers(headers) if headers is not None else None
+        self.body = body
+        self.checked_at = time.monotonic()
+        # Response.find_precompressed() result, looked up again with the file
+        self.precompressed = None
+        self.precompressed_checked = False
+
+    def matches(self, file_stat):
+        return self.size == file_stat.st_size and self.mtime == file_stat.st_mtime_ns
+
+
+class StreamedFile:
+    # FileCache marker for a file too big to keep, so a hot big file costs a
+    # stat per check_interval instead of a miss on every request
+    size = MARKER_ENTRY_SIZE
+    body = None
+
+    def __init__(self, file_size, mtime):
+        self.file_size = file_size
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+    def matches(self, file_stat):
+        return self.file_size == file_stat.st_size and self.mtime == file_stat.st_mtime_ns
+
+
+class LRUCache:
+    # entries limited by the sum of their sizes, shared by the threads of a process
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # bumped without the lock, good enough for a hit rate
+        self.hits = 0
+        self.misses = 0
+        # lookups of what the cache knows it will not hold
+        self.bypassed = 0
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+
+class FileCache(LRUCache):
+    # LRU of small files kept in memory together with their headers, limited
+    # by the total size of the bodies. An entry is trusted for check_interval
+    # seconds, after that a stat tells if the file has to be read again.
+    def __init__(self, max_size=CACHE_SIZE, max_file_size=CACHE_MAX_FILE_SIZE,
+                 check_interval=CACHE_CHECK_INTERVAL):
+        super().__init__(max_size)
+        self.max_file_size = min(max_file_size, max_size)
+        self.check_interval = check_interval
+
+    def get(self, path):
+        # None means the file is not cacheable and the caller takes the slow path
+        now = time.monotonic()
+        entry = self.lookup(path)
+        if entry is not None and now - entry.checked_at < self.check_interval:
+            return self.found(entry)
+
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            self.misses += 1
+            self.discard(path)
+            return None
+
+        if entry is not None and entry.matches(file_stat):
+            entry.checked_at = now
+            entry.precompressed_checked = False
+            return self.found(entry)
+
+        self.misses += 1
+        self.discard(path)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        if file_stat.st_size > self.max_file_size:
+            self.put(path, StreamedFile(file_stat.st_size, file_stat.st_mtime_ns))
+            return None
+        content_type = get_content_type(path)
+        if content_type not in ALLOWED_CONTENT_TYPE:
+            return None
+        try:
+            with open(path, "rb") as file:
+                body = file.read()
+        except OSError:
+            return None
+        if len(body) != file_stat.st_size:
+            # changed while being read
+            return None
+
+        entry = CachedFile(
+            size=file_stat.st_size,
+            mtime=file_stat.st_mtime_ns,
+            headers=get_file_headers(content_type, file_stat),
+            body=body
+        )
+        self.put(path, entry)
+        return entry
+
+    def found(self, entry):
+        if entry.body is None:
+            self.bypassed += 1
+            return None
+        self.hits += 1
+        return entry
+
+
+class GzipCache(LRUCache):
+    # Gzipped copies of text files, made on the first request for them. The key
+    # has the mtime and size in it, stale copies just age out of the LRU.
+    def __init__(self, max_size=GZIP_CACHE_SIZE, max_file_size=GZIP_MAX_FILE_SIZE):
+        super().__init__(max_size)
+        self.max_file_size = max_file_size
+
+    def get(self, path, mtime, size, content=None, compress=True):
+        # None when the file should be sent as it is; without compress only an
+        # existing copy is returned
+        if size < GZIP_MIN_SIZE or size > self.max_file_size:
+            return None
+        key = (path, mtime, size)
+        entry = self.lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry.body
+        if not compress:
+            return None
+        self.misses += 1
+
+        if content is None:
+            try:
+                with open(path, "rb") as file:
+                    content = file.read()
+            except OSError:
+                return None
+            if len(content) != size:
+                return None
+
+        compressed = gzip.compress(content, GZIP_LEVEL, mtime=0)
+        if len(compressed) >= size:
+            # remember that it does not pay off
+            compressed = None
+        self.put(key, CachedFile(len(compressed) if compressed else MARKER_ENTRY_SIZE, mtime, None, compressed))
+        return compressed
+
+
+def resolve_path(document_root, url_path):
+    # (status, path) for a decoded url path, document_root has to be a real path.
+    # Symlinks are followed, but the result has to stay inside the root.
+    if url_path.endswith('/'):
+        url_path += 'index.html'
+    try:
+        path = os.path.realpath(os.path.join(document_root, url_path.lstrip('/')))
+        if os.path.commonpath([document_root, path]) != document_root:
+            return FORBIDDEN, path
+        file_stat = os.stat(path)
+    except (OSError, ValueError):
+        return NOT_FOUND, None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return FORBIDDEN, path
+    return OK, path
+
+
+class ResolvedPath:
+    size = 1
+
+    def __init__(self, status, path, expires):
+        self.status = status
+        self.path = path
+        self.expires = expires
+
+
+class PathResolver(LRUCache):
+    # Remembers resolve_path() results, misses included, for ttl seconds, so
+    # repeated requests and 404 storms from scanners do not touch the disk.
+    def __init__(self, document_root, ttl=PATH_CACHE_TTL, max_entries=PATH_CACHE_ENTRIES):
+        super().__init__(max_entries)
+        self.document_root = os.path.realpath(document_root)
+        self.ttl = ttl
+
+    def resolve(self, url_path):
+        now = time.monotonic()
+        entry = self.lookup(url_path)
+        if entry is not None and entry.expires >= now:
+            self.hits += 1
+        else:
+            self.misses += 1
+            status, path = resolve_path(self.document_root, url_path)
+            entry = ResolvedPath(status, path, now + self.ttl)
+            if self.ttl:
+                self.put(url_path, entry)
+        return entry.status, entry.path
+
+
+def accepts_gzip(accept_encoding):
+    # an explicit gzip entry wins over *, whatever the order, and q=0 refuses
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        if coding not in ("gzip", "*"):
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities.get("gzip", qualities.get("*", 0)) > 0
+
+
+def get_precompressed_stat(gz_path, mtime):
+    # a .gz sibling older than the file itself is stale and ignored
+    try:
+        gz_stat = os.stat(gz_path)
+    except OSError:
+        return None
+    if gz_stat.st_mtime_ns < mtime:
+        return None
+    return gz_stat
+
+
+class Metrics:
+    # Counters of one worker, only its own thread writes them, so recording
+    # is a few integer additions without any locking.
+    def __init__(self):
+        self.statuses = {}
+        self.sent_bytes = 0
+        self.accepted = 0
+        self.active = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def observe(self, status, latency):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency_buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+
+
+def render_metrics(metrics_list, caches):
+    # Prometheus text format, the workers of this process summed up
+    statuses = {}
+    latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+    for metrics in metrics_list:
+        for status, count in list(metrics.statuses.items()):
+            statuses[status] = statuses.get(status, 0) + count
+        for number, count in enumerate(metrics.latency_buckets):
+            latency_buckets[number] += count
+
+    lines = [
+        "# HELP httpd_requests_total Answered requests by status code.",
+        "# TYPE httpd_requests_total counter",
+    ]
+    lines.extend('httpd_requests_total{status="%s"} %d' % item for item in sorted(statuses.items()))
+    lines.extend([
+        "# HELP httpd_sent_bytes_total Bytes written to clients.",
+        "# TYPE httpd_sent_bytes_total counter",
+        "httpd_sent_bytes_total %d" % sum(metrics.sent_bytes for metrics in metrics_list),
+        "# HELP httpd_connections_accepted_total Accepted connections.",
+        "# TYPE httpd_connections_accepted_total counter",
+        "httpd_connections_accepted_total %d" % sum(metrics.accepted for metrics in metrics_list),
+        "# HELP httpd_connections_active Open client connections.",
+        "# TYPE httpd_connections_active gauge",
+        "httpd_connections_active %d" % sum(metrics.active for metrics in metrics_list),
+        "# HELP httpd_response_seconds From accept, or from the request on a reused connection, "
+        "to the response being ready to write.",
+        "# TYPE httpd_response_seconds histogram",
+    ])
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], latency_buckets):
+        cumulative += count
+        lines.append('httpd_response_seconds_bucket{le="%s"} %d' % (bound, cumulative))
+    lines.append("httpd_response_seconds_sum %f" % sum(metrics.latency_sum for metrics in metrics_list))
+    lines.append("httpd_response_seconds_count %d" % cumulative)
+
+    lines.extend([
+        "# HELP httpd_cache_hits_total Lookups answered from memory.",
+        "# TYPE httpd_cache_hits_total counter",
+    ])
+    lines.extend('httpd_cache_hits_total{cache="%s"} %d' % (name, cache.hits) for name, cache in caches)
+    lines.extend([
+        "# HELP httpd_cache_misses_total Lookups that went to the file system.",
+        "# TYPE httpd_cache_misses_total counter",
+    ])
+    lines.extend('httpd_cache_misses_total{cache="%s"} %d' % (name, cache.misses) for name, cache in caches)
+    lines.extend([
+        "# HELP httpd_cache_bypassed_total Lookups of files known to be too big to cache.",
+        "# TYPE httpd_cache_bypassed_total counter",
+    ])
+    lines.extend('httpd_cache_bypassed_total{cache="%s"} %d' % (name, cache.bypassed) for name, cache in caches)
+    lines.extend([
+        "# HELP httpd_cache_size_bytes Memory held by a cache, entries for the path cache.",
+        "# TYPE httpd_cache_size_bytes gauge",
+    ])
+    lines.extend('httpd_cache_size_bytes{cache="%s"} %d' % (name, cache.size) for name, cache in caches)
+    return ("\n".join(lines) + "\n").encode("utf-8")
 
 
 class Response:
-    def __init__(self, raw_data, document_root):
+    def __init__(self, raw_data, document_root, keep_alive_allowed=True, file_cache=None, gzip_cache=None,
+                 path_resolver=None, status_page=None):
         self.raw_data = raw_data
         self.document_root = document_root
+        self.file_cache = file_cache
+        self.gzip_cache = gzip_cache
+        self.path_resolver = path_resolver
+        self.status_page = status_page
         self.status = None
         self.response_headers = {}
+        self.request_headers = {}
         self.method = None
-        self.body = b''
+        self.url_path = None
+        self.path = None
+        self.mtime = None
+        self.size = None
+        self.encoded_body = None
+        self.encoded_path = None
+        self.body = []
         self.protocol_version = "HTTP/1.1"
-        self.response = b''
+        self.keep_alive_allowed = keep_alive_allowed
+        self.keep_alive = False
+        self.header_block = None
+        self.segments = []
+        self.response_size = 0
 
     def parse_data(self):
-        try:
-            first_string = self.raw_data[:self.raw_data.find("\r\n")].split()
-        except (KeyError, IndexError):
-            self.status = BAD_REQUEST
-            return
-
+        request_line, _, header_block = self.raw_data.partition(b"\r\n")
+        first_string = request_line.decode("utf-8", errors="replace").split()
         if len(first_string) == 3:
             self.method, url, self.protocol_version = first_string
         elif len(first_string) == 2:
             self.method, url = first_string
-        elif len(first_string) == 1:
-            self.method = first_string
+        else:
+            self.status = BAD_REQUEST
+            return
 
-        request = urllib.parse.unquote(url)
-        self.path = self.document_root + request + "index.html" if request.endswith('/') else self.document_root + os.path.realpath(request)
+        # the query is cut off before unquoting, %3F is a part of the name
+        self.url_path = urllib.parse.unquote(url.split("?", 1)[0])
 
-        if "?" in self.path:
-            self.path = self.path.split("?")[0]
+        for header_line in header_block.split(b"\r\n"):
+            header, _, value = header_line.partition(b":")
+            name = REQUEST_HEADERS.get(header.strip().lower())
+            if name is not None:
+                self.request_headers[name] = value.strip().decode("latin-1")
 
-        all_lines = self.raw_data.split('\r\n')
-        for header_line in all_lines[1:]:
-            if not header_line:
-                break
-            header, value = header_line.split(":", 1)
-            if header == "Connection":
-                self.response_headers[header] = value.strip()
+        connection = self.request_headers.get("connection", "").lower()
+        if self.protocol_version == "HTTP/1.1":
+            self.keep_alive = connection != "close"
+        else:
+            self.keep_alive = connection == "keep-alive"
 
     def handle(self):
         self.parse_data()
+        if self.status == BAD_REQUEST:
+            return
+
         if self.method not in ["GET", "HEAD"]:
+            # the body of such a request is never read, so the connection
+            # can not be reused
+            self.keep_alive = False
             self.status = NOT_ALLOWED
+            return
 
-        self.set_headers()
+        if self.status_page is not None and self.url_path == STATUS_PATH:
+            page = self.status_page()
+            self.status = OK
+            self.response_headers['Content-Type'] = METRICS_CONTENT_TYPE
+            self.response_headers['Content-Length'] = str(len(page))
+            self.response_headers['Cache-Control'] = 'no-cache'
+            if self.method == "GET":
+                self.body = [page]
+            return
+
+        self.status, self.path = self.resolve(self.url_path)
+        if self.status != OK:
+            return
+
+        cached = self.file_cache.get(self.path) if self.file_cache is not None else None
+        if cached is not None:
+            self.status = OK
+            self.response_headers.update(cached.headers)
+            self.header_block = cached.header_block
+            self.mtime, self.size = cached.mtime, cached.size
+        else:
+            self.set_headers()
+
+        if self.status == OK:
+            self.set_encoding(cached)
+
+        if self.status == OK and self.is_not_modified():
+            self.status = NOT_MODIFIED
+            self.response_headers.pop('Content-Type', None)
+            self.response_headers.pop('Content-Length', None)
+            return
 
         if self.method == "HEAD":
             return
         
         if self.status != OK:
             return
-        
-        if self.method == "GET":
-            with open(self.path, "rb") as file:
-                self.body = file.read()
 
-        self.status = OK
+        if self.encoded_body is not None:
+            self.body = [self.encoded_body]
+            return
+
+        if self.encoded_path is not None:
+            file = open(self.encoded_path, "rb")
+            size = os.fstat(file.fileno()).st_size
+            self.response_headers['Content-Length'] = str(size)
+            if size < SENDFILE_MIN_SIZE:
+                with file:
+                    self.body = [file.read()]
+            else:
+                self.body = [FileBody(file, 0, size)]
+            return
+
+        if cached is not None:
+            content, size = cached.body, cached.size
+        else:
+            content = open(self.path, "rb")
+            size = os.fstat(content.fileno()).st_size
+            self.response_headers['Content-Length'] = str(size)
+            if size < SENDFILE_MIN_SIZE:
+                with content:
+                    content = content.read()
+
+        ranges = self.get_ranges(size)
+        if ranges is None:
+            self.body = [content if isinstance(content, bytes) else FileBody(content, 0, size)]
+        elif ranges:
+            self.set_partial_body(content, size, ranges)
+        else:
+            self.status = RANGE_NOT_SATISFIABLE
+            self.response_headers['Content-Range'] = 'bytes */%d' % size
+            if not isinstance(content, bytes):
+                content.close()
+
+    def resolve(self, url_path):
+        # every file the response opens is found here, inside the document root
+        if self.path_resolver is not None:
+            return self.path_resolver.resolve(url_path)
+        return resolve_path(os.path.realpath(self.document_root), url_path)
+
+    def find_precompressed(self):
+        # (path, size) of a fresh .gz sibling, looked up like a request for it,
+        # so a symlink out of the document root is refused here too
+        document_root = (
+            self.path_resolver.document_root if self.path_resolver is not None
+            else os.path.realpath(self.document_root)
+        )
+        status, gz_path = self.resolve("/" + os.path.relpath(self.path + ".gz", document_root))
+        if status != OK:
+            return None
+        gz_stat = get_precompressed_stat(gz_path, self.mtime)
+        if gz_stat is None:
+            return None
+        return gz_path, gz_stat.st_size
+
+    def set_encoding(self, cached):
+        if self.response_headers['Content-Type'] not in COMPRESSIBLE_CONTENT_TYPE:
+            return
+        # ranges are always served from the identity encoding
+        if "range" in self.request_headers or not accepts_gzip(self.request_headers.get("accept-encoding", "")):
+            return
+
+        if cached is not None:
+            # a warm hit does not touch the file system for the sibling either
+            if not cached.precompressed_checked:
+                cached.precompressed = self.find_precompressed()
+                cached.precompressed_checked = True
+            precompressed = cached.precompressed
+        else:
+            precompressed = self.find_precompressed()
+        if precompressed is not None:
+            self.encoded_path, size = precompressed
+        elif self.gzip_cache is not None:
+            # a HEAD does not send the body, it is not worth compressing the
+            # whole file for its Content-Length
+            self.encoded_body = self.gzip_cache.get(
+                self.path, self.mtime, self.size, cached.body if cached is not None else None,
+                compress=self.method != "HEAD")
+            if self.encoded_body is None:
+                return
+            size = len(self.encoded_body)
+        else:
+            return
+
+        self.response_headers['Content-Encoding'] = 'gzip'
+        self.response_headers['Content-Length'] = str(size)
+        # another representation needs another etag
+        self.response_headers['ETag'] = self.response_headers['ETag'][:-1] + '-gzip"'
+
+    def get_ranges(self, size):
+        range_header = self.request_headers.get("range")
+        if range_header is None:
+            return None
+        # If-Range: only send a part if the client still has the same version
+        if_range = self.request_headers.get("if-range")
+        if if_range is not None and if_range not in (self.response_headers['ETag'],
+                                                     self.response_headers['Last-Modified']):
+            return None
+        return parse_range(range_header, size)
+
+    def set_partial_body(self, content, size, ranges):
+        def get_part(first, last, owns_file):
+            if isinstance(content, bytes):
+                return memoryview(content)[first:last + 1]
+            return FileBody(content, first, last - first + 1, owns_file)
+
+        self.status = PARTIAL_CONTENT
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            self.response_headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            self.response_headers['Content-Length'] = str(last - first + 1)
+            self.body = [get_part(first, last, True)]
+            return
+
+        boundary = ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+        content_type = self.response_headers['Content-Type']
+        self.body = []
+        for number, (first, last) in enumerate(ranges):
+            self.body.append((
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {first}-{last}/{size}\r\n\r\n"
+            ).encode("utf-8"))
+            self.body.append(get_part(first, last, number == len(ranges) - 1))
+        self.body.append(f"\r\n--{boundary}--\r\n".encode("utf-8"))
+        self.response_headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+        self.response_headers['Content-Length'] = str(sum(
+            segment.count if isinstance(segment, FileBody) else len(segment) for segment in self.body
+        ))
+
+    def is_not_modified(self):
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if_none_match = self.request_headers.get("if-none-match")
+        if if_none_match is not None:
+            etag = self.response_headers['ETag']
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag == "*" or tag.replace("W/", "", 1) == etag:
+                    return True
+            return False
+
+        if_modified_since = self.request_headers.get("if-modified-since")
+        if if_modified_since is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError, IndexError):
+            return False
+        if since is None or since.tzinfo is None:
+            return False
+        last_modified = parsedate_to_datetime(self.response_headers['Last-Modified'])
+        return last_modified <= since
 
     def set_headers(self):
         if os.path.isfile(self.path):
             try:
-                size = os.stat(self.path).st_size
+                file_stat = os.stat(self.path)
             except OSError:
                 self.status = NOT_FOUND
                 return
 
-            filename = self.path.split("/")[-1]
-            content_type, _ = mimetypes.guess_type(filename)
+            content_type = get_content_type(self.path)
             if content_type not in ALLOWED_CONTENT_TYPE:
                 self.status = NOT_ALLOWED
                 return
-            self.response_headers['Content-Type'] = content_type
-            self.response_headers['Content-Length'] = str(size)
+            self.response_headers.update(get_file_headers(content_type, file_stat))
+            self.mtime, self.size = file_stat.st_mtime_ns, file_stat.st_size
             self.status = OK
         elif not os.path.exists(self.path):
             self.status = NOT_FOUND
@@ -113,24 +882,114 @@ class Response:
             self.status = FORBIDDEN
 
     def prepare_response(self):
-        self.response_headers['Connection'] = 'close'
-        headers = "\r\n".join(
-            f"{key}: {value}" for key, value in self.response_headers.items()
+        self.keep_alive = self.keep_alive and self.keep_alive_allowed and self.status != BAD_REQUEST
+        if self.status not in (OK, PARTIAL_CONTENT, NOT_MODIFIED):
+            # the client needs to know where this response ends to reuse the connection
+            self.response_headers['Content-Length'] = '0'
+        # headers of a cached file only change for other statuses or with gzip
+        if self.header_block is not None and self.status == OK and 'Content-Encoding' not in self.response_headers:
+            headers = self.header_block
+        else:
+            headers = encode_headers(self.response_headers)
+
+        response = b"".join([
+            STATUS_LINES[self.status],
+            headers,
+            SERVER_HEADER,
+            DATE_HEADER.get(),
+            CONNECTION_HEADERS[self.keep_alive],
+            b"\r\n",
+        ])
+        body = self.body if self.status in (OK, PARTIAL_CONTENT) else []
+        self.segments = join_segments([response] + body)
+        self.response_size = sum(
+            segment.count if isinstance(segment, FileBody) else len(segment) for segment in self.segments
         )
 
-        headers += "\r\nServer: OTUS\r\n"
-        headers += f"Date: {datetime.now(timezone.utc)}\n\n"
+    def close(self):
+        close_segments(self.body)
 
-        response = f"\r\n{self.protocol_version} {self.status} {MAP_STATUS_TO_TEXT[self.status]}\r\n"
-        response += headers
-        response = response.encode("utf-8")
-        body = self.body if self.status == OK else b''
-        self.response = response + body
-       
 
+class HeaderTooLarge(Exception):
+    pass
 
-class Worker(threading.Thread):
-    def __init__(self, host, port, server_socket, document_root):
+
+class RequestReader:
+    # Cuts complete request heads out of the incoming bytes. Only the data that
+    # arrived since the last call is searched for the blank line, so a head
+    # trickling in byte by byte is not rescanned from the start every time.
+    def __init__(self, max_header_size=MAX_HEADER_SIZE):
+        self.max_header_size = max_header_size
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buffer += data
+        requests = []
+        start = 0
+        while True:
+            # the terminator may have started in the previous piece
+            end = self.buffer.find(b'\r\n\r\n', max(start, self.scanned - 3))
+            if end == -1:
+                break
+            if end + 4 - start > self.max_header_size:
+                raise HeaderTooLarge()
+            requests.append(bytes(self.buffer[start:end + 4]))
+            start = end + 4
+        if start:
+            del self.buffer[:start]
+        self.scanned = len(self.buffer)
+        if self.scanned > self.max_header_size:
+            raise HeaderTooLarge()
+        return requests
+
+
+def build_response(raw_request, document_root, keep_alive_allowed=True, file_cache=None, gzip_cache=None,
+                   path_resolver=None, status_page=None):
+    response = Response(
+        raw_data=raw_request,
+        document_root=document_root,
+        keep_alive_allowed=keep_alive_allowed,
+        file_cache=file_cache,
+        gzip_cache=gzip_cache,
+        path_resolver=path_resolver,
+        status_page=status_page
+    )
+    response.handle()
+    response.prepare_response()
+    return response
+
+
+def wait_signal(signals, timeout):
+    # the number of the first of the blocked signals to arrive, None after timeout
+    if HAS_SIGTIMEDWAIT:
+        info = signal.sigtimedwait(signals, timeout)
+        return info.si_signo if info is not None else None
+    # a timer set to 0 is off, the wait has to end anyway
+    signal.setitimer(signal.ITIMER_REAL, max(timeout, 0.001))
+    try:
+        signum = signal.sigwait(set(signals) | {signal.SIGALRM})
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    # a late SIGALRM left pending only makes the next wait return early
+    return signum if signum != signal.SIGALRM else None
+
+
+def build_error_response(status):
+    # for requests that can not even be parsed, the connection is closed after it
+    response = Response(raw_data=b'', document_root='')
+    response.status = status
+    response.prepare_response()
+    return response
+
+
+class BaseWorker(threading.Thread):
+    # Settings and the request to response step shared by the engines, which
+    # differ only in how they move bytes between the sockets and respond()
+    def __init__(self, host, port, server_socket, document_root,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, keepalive_requests=KEEPALIVE_REQUESTS,
+                 file_cache=None, gzip_cache=None, path_resolver=None,
+                 request_timeout=REQUEST_TIMEOUT, max_header_size=MAX_HEADER_SIZE, status_page=None):
         super().__init__()
         self.daemon = True
         self.host = host
@@ -138,70 +997,705 @@ class Worker(threading.Thread):
         self.server_socket = server_socket
         self.worker_name = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
         self.document_root = document_root
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+        self.file_cache = file_cache
+        self.gzip_cache = gzip_cache
+        self.path_resolver = path_resolver
+        self.request_timeout = request_timeout
+        self.max_header_size = max_header_size
+        self.status_page = status_page
+        self.metrics = Metrics()
+        self.stopping = threading.Event()
+
+    def stop(self):
+        # from any thread: stop accepting, let open connections finish
+        self.stopping.set()
+
+    def respond(self, raw_request, served, started):
+        # served counts this request too, started is when it began to arrive
+        response = build_response(
+            raw_request, self.document_root,
+            keep_alive_allowed=served < self.keepalive_requests and not self.stopping.is_set(),
+            file_cache=self.file_cache,
+            gzip_cache=self.gzip_cache,
+            path_resolver=self.path_resolver,
+            status_page=self.status_page
+        )
+        self.metrics.observe(response.status, time.monotonic() - started)
+        return response
+
+
+class Worker(BaseWorker):
+    # A thread serving one connection at a time with blocking sockets
 
-    def read_data(self, client_connection):
-        raw_data = ''
+    def read_data(self, client_connection, reader, served):
+        # an idle keep-alive connection may wait keepalive_timeout for the next
+        # request, but once it started the whole head has to arrive within
+        # request_timeout, so a slow client can not hold the thread forever.
+        # The idle wait is cut into SELECT_TIMEOUT slices to notice stop().
+        deadline = time.monotonic() + self.request_timeout if reader.buffer else None
+        idle_deadline = time.monotonic() + self.keepalive_timeout
         while True:
-            part = client_connection.recv(1024).decode('utf-8')
-            raw_data += part
-            if raw_data.find('\r\n\r\n') != -1 or not part:
-                break
-        return raw_data
+            if deadline is None:
+                if served and self.stopping.is_set():
+                    return []
+                remaining = idle_deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("keep-alive connection timed out")
+                client_connection.settimeout(min(remaining, SELECT_TIMEOUT))
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("request head timed out")
+                client_connection.settimeout(remaining)
+
+            try:
+                part = client_connection.recv(RECV_SIZE)
+            except socket.timeout:
+                if deadline is None:
+                    continue
+                raise
+            if not part:
+                return []
+            requests = reader.feed(part)
+            if requests:
+                return requests
+            if deadline is None:
+                deadline = time.monotonic() + self.request_timeout
 
     def send_response(self, response, connection):
+        for segment in response.segments:
+            if isinstance(segment, FileBody):
+                segment.send_all(connection)
+            else:
+                connection.sendall(segment)
+        self.metrics.sent_bytes += response.response_size
+
+    def handle_connection(self, client_connection, accepted_at):
+        reader = RequestReader(self.max_header_size)
+        served = 0
+        started = accepted_at
+        while True:
+            try:
+                requests = self.read_data(client_connection, reader, served)
+            except HeaderTooLarge:
+                self.send_response(build_error_response(REQUEST_HEADER_FIELDS_TOO_LARGE), client_connection)
+                return
+            if not requests:
+                return
+            if served:
+                started = time.monotonic()
+            client_connection.settimeout(self.keepalive_timeout)
+            for raw_request in requests:
+                served += 1
+                response = self.respond(raw_request, served, started)
+                try:
+                    self.send_response(response=response, connection=client_connection)
+                finally:
+                    response.close()
+                if not response.keep_alive:
+                    return
+
+    def run(self):
+        # the listening socket has a SELECT_TIMEOUT timeout, so accept()
+        # returns now and then to look at the stop flag
+        while not self.stopping.is_set():
+            try:
+                client_connection, client_address = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                logging.exception("An error when accept connection")
+                continue
+
+            self.metrics.accepted += 1
+            self.metrics.active += 1
+            try:
+                self.handle_connection(client_connection, time.monotonic())
+            except socket.timeout:
+                pass
+            except socket.error as e:
+                logging.error('%s: socket error %s ' % (self.worker_name, e))
+            except Exception:
+                logging.exception('%s: can not handle request' % self.worker_name)
+            finally:
+                self.metrics.active -= 1
+                client_connection.close()
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = None
+        # when the first byte of a still incomplete request head arrived
+        self.request_started = None
+        # bytes as memoryviews and FileBody regions, in sending order
+        self.out_segments = deque()
+        self.served = 0
+        self.close_after_write = False
+        self.accepted_at = self.last_active = time.monotonic()
+
+
+class EventLoopWorker(BaseWorker):
+    # One thread multiplexing many non-blocking connections with selectors
+    # (epoll on Linux, kqueue on BSD/macOS). Every loop thread watches the
+    # shared listening socket and accepts whatever it manages to grab.
+    # stop() is noticed within SELECT_TIMEOUT.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+
+    def accept(self):
+        while True:
+            try:
+                client_connection, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                # another loop got the connection first or the backlog is drained
+                return
+            except socket.error:
+                logging.exception("An error when accept connection")
+                return
+            client_connection.setblocking(False)
+            connection = Connection(client_connection)
+            connection.reader = RequestReader(self.max_header_size)
+            self.metrics.accepted += 1
+            self.metrics.active += 1
+            self.connections[client_connection] = connection
+            self.selector.register(client_connection, selectors.EVENT_READ, connection)
+
+    def close(self, connection):
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        if self.connections.pop(connection.sock, None) is not None:
+            self.metrics.active -= 1
+        for segment in connection.out_segments:
+            if isinstance(segment, FileBody):
+                segment.close()
+        connection.out_segments.clear()
+        connection.sock.close()
+
+    def close_idle(self):
+        now = time.monotonic()
+        deadline = now - self.keepalive_timeout
+        request_deadline = now - self.request_timeout
+        for connection in list(self.connections.values()):
+            if connection.last_active < deadline:
+                self.close(connection)
+            elif connection.request_started is not None and connection.request_started < request_deadline:
+                # slowloris: bytes keep coming, the request never completes
+                self.close(connection)
+
+    def close_drained(self):
+        # while stopping: connections that got their answers and wait for the
+        # next request are closed, everything else is finished first
+        for connection in list(self.connections.values()):
+            if connection.served and not connection.out_segments and not connection.reader.buffer:
+                self.close(connection)
+
+    def handle_read(self, connection):
         try:
-            while len(response) > 1024:
-                connection.sendall(response[0:1024])
-                response = response[1024:]
-            if response:
-                connection.sendall(response)
+            part = connection.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
         except socket.error as e:
             logging.error('%s: socket error %s ' % (self.worker_name, e))
-        connection.close()
-        
+            self.close(connection)
+            return
+
+        if not part:
+            self.close(connection)
+            return
+
+        connection.last_active = time.monotonic()
+        try:
+            requests = connection.reader.feed(part)
+        except HeaderTooLarge:
+            connection.close_after_write = True
+            connection.out_segments.extend(
+                memoryview(segment) for segment in build_error_response(REQUEST_HEADER_FIELDS_TOO_LARGE).segments)
+            self.selector.modify(connection.sock, selectors.EVENT_WRITE, connection)
+            self.handle_write(connection)
+            return
+
+        if not connection.reader.buffer:
+            connection.request_started = None
+        elif connection.request_started is None or requests:
+            connection.request_started = connection.last_active
+        if requests:
+            self.process_requests(connection, requests)
+
+    def process_requests(self, connection, requests):
+        # answers to pipelined requests go out together, in order
+        segments = []
+        started = connection.accepted_at if not connection.served else connection.last_active
+        for raw_request in requests:
+            connection.served += 1
+            try:
+                response = self.respond(raw_request, connection.served, started)
+            except Exception:
+                logging.exception('%s: can not handle request' % self.worker_name)
+                close_segments(segments)
+                self.close(connection)
+                return
+            segments.extend(response.segments)
+            if not response.keep_alive:
+                connection.close_after_write = True
+                break
+
+        for segment in join_segments(segments):
+            connection.out_segments.append(segment if isinstance(segment, FileBody) else memoryview(segment))
+        self.selector.modify(connection.sock, selectors.EVENT_WRITE, connection)
+        self.handle_write(connection)
+
+    def send_segments(self, connection):
+        # writes until everything is sent or the socket buffer is full
+        segments = connection.out_segments
+        while segments:
+            segment = segments[0]
+            if isinstance(segment, FileBody):
+                self.metrics.sent_bytes += segment.send(connection.sock)
+                if not segment.count:
+                    segment.close()
+                    segments.popleft()
+            else:
+                sent = connection.sock.send(segment)
+                self.metrics.sent_bytes += sent
+                if sent < len(segment):
+                    segments[0] = segment[sent:]
+                else:
+                    segments.popleft()
+
+    def handle_write(self, connection):
+        try:
+            self.send_segments(connection)
+        except (BlockingIOError, InterruptedError):
+            connection.last_active = time.monotonic()
+            return
+        except OSError as e:
+            logging.error('%s: socket error %s ' % (self.worker_name, e))
+            self.close(connection)
+            return
+
+        connection.last_active = time.monotonic()
+        if connection.close_after_write:
+            self.close(connection)
+            return
+
+        self.selector.modify(connection.sock, selectors.EVENT_READ, connection)
 
     def run(self):
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        accepting = True
+        last_idle_check = time.monotonic()
         while True:
+            if self.stopping.is_set():
+                if accepting:
+                    self.selector.unregister(self.server_socket)
+                    accepting = False
+                self.close_drained()
+                if not self.connections:
+                    return
+
+            for key, events in self.selector.select(timeout=SELECT_TIMEOUT):
+                connection = key.data
+                if connection is None:
+                    self.accept()
+                elif events & selectors.EVENT_READ:
+                    self.handle_read(connection)
+                elif events & selectors.EVENT_WRITE:
+                    self.handle_write(connection)
+
+            now = time.monotonic()
+            if now - last_idle_check >= SELECT_TIMEOUT:
+                self.close_idle()
+                last_idle_check = now
+
+
+class AsyncioWorker(BaseWorker):
+    # A thread running its own asyncio loop with a coroutine per connection,
+    # so idle keep-alive connections cost a few objects instead of a thread.
+    # handle_connection only needs a running loop and can be mounted into
+    # another asyncio application with asyncio.start_server.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.stop_requested = None
+        self.drained = None
+        # writers of connections waiting for their next request
+        self.idle_writers = set()
+
+    def stop(self):
+        super().stop()
+        if self.loop is not None:
             try:
-                client_connection, client_address = self.server_socket.accept()
-            except socket.error as e:
-                logging.exception("An error when accept connection")
+                self.loop.call_soon_threadsafe(self.stop_requested.set)
+            except RuntimeError:
+                # the loop already finished
+                pass
 
-            data = self.read_data(client_connection)
-            if data:
-                response = Response(
-                    raw_data=data, document_root=self.document_root)
-                response.handle()
-                response.prepare_response()
-                self.send_response(response=response.response, connection=client_connection)
+    async def read_data(self, stream_reader, writer, reader, served):
+        # the same limits as Worker.read_data, stopping closes idle writers
+        deadline = time.monotonic() + self.request_timeout if reader.buffer else None
+        while True:
+            if deadline is None:
+                if served and self.stopping.is_set():
+                    return []
+                timeout = self.keepalive_timeout
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise asyncio.TimeoutError("request head timed out")
+
+            if deadline is None and served:
+                self.idle_writers.add(writer)
+            try:
+                part = await asyncio.wait_for(stream_reader.read(RECV_SIZE), timeout)
+            finally:
+                self.idle_writers.discard(writer)
+            if not part:
+                return []
+            requests = reader.feed(part)
+            if requests:
+                return requests
+            if deadline is None:
+                deadline = time.monotonic() + self.request_timeout
+
+    async def send_response(self, response, writer):
+        # drain() returns at once while the transport buffer is below
+        # WRITE_BUFFER_HIGH and waits for the client otherwise; loop.sendfile
+        # flushes the buffer first and reads the file in chunks itself when
+        # the transport can not use os.sendfile
+        loop = asyncio.get_running_loop()
+        for segment in response.segments:
+            if isinstance(segment, FileBody):
+                await loop.sendfile(writer.transport, segment.file, segment.offset, segment.count)
+                segment.offset += segment.count
+                segment.count = 0
+            else:
+                writer.write(segment)
+                await writer.drain()
+        self.metrics.sent_bytes += response.response_size
+
+    async def serve_requests(self, stream_reader, writer, accepted_at):
+        reader = RequestReader(self.max_header_size)
+        served = 0
+        started = accepted_at
+        while True:
+            try:
+                requests = await self.read_data(stream_reader, writer, reader, served)
+            except HeaderTooLarge:
+                await self.send_response(build_error_response(REQUEST_HEADER_FIELDS_TOO_LARGE), writer)
+                return
+            if not requests:
+                return
+            if served:
+                started = time.monotonic()
+            for raw_request in requests:
+                served += 1
+                response = self.respond(raw_request, served, started)
+                try:
+                    await self.send_response(response, writer)
+                finally:
+                    response.close()
+                if not response.keep_alive:
+                    return
+
+    async def handle_connection(self, stream_reader, writer):
+        self.metrics.accepted += 1
+        self.metrics.active += 1
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        try:
+            await self.serve_requests(stream_reader, writer, time.monotonic())
+        except asyncio.TimeoutError:
+            pass
+        except OSError as e:
+            logging.error('%s: socket error %s ' % (self.worker_name, e))
+        except Exception:
+            logging.exception('%s: can not handle request' % self.worker_name)
+        finally:
+            await self.close_writer(writer)
+            self.metrics.active -= 1
+            if self.stopping.is_set() and not self.metrics.active:
+                self.drained.set()
+
+    async def close_writer(self, writer):
+        # close() only schedules it, what is still buffered goes out first
+        writer.close()
+        try:
+            await asyncio.wait_for(writer.wait_closed(), self.keepalive_timeout)
+        except asyncio.TimeoutError:
+            writer.transport.abort()
+        except OSError:
+            pass
+
+    async def serve(self):
+        self.stop_requested = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        # every loop accepts on the shared listening socket, like
+        # EventLoopWorker, through its own descriptor: closing the server on
+        # stop must not close the socket the other workers still use
+        listen_socket = self.server_socket.dup()
+        server = await asyncio.start_server(self.handle_connection, sock=listen_socket, backlog=LISTEN_BACKLOG)
+        if self.stopping.is_set():
+            self.stop_requested.set()
+        await self.stop_requested.wait()
+
+        # connections accepted just before need a few loop iterations to get
+        # their transports, which fails once the server is closed
+        self.loop.remove_reader(listen_socket)
+        await asyncio.sleep(SELECT_TIMEOUT)
+        server.close()
+        for writer in list(self.idle_writers):
+            writer.close()
+        if self.metrics.active:
+            await self.drained.wait()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+WORKER_CLASSES = {
+    ENGINE_THREAD: Worker,
+    ENGINE_EPOLL: EventLoopWorker,
+    ENGINE_ASYNCIO: AsyncioWorker,
+}
 
 
 class HTTPServer:
-    def __init__(self, document_root, host, port, workers):
+    def __init__(self, document_root, host, port, workers, engine=ENGINE_THREAD, processes=0, reuse_port=False,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, keepalive_requests=KEEPALIVE_REQUESTS,
+                 cache_size=CACHE_SIZE, cache_max_file_size=CACHE_MAX_FILE_SIZE,
+                 cache_check_interval=CACHE_CHECK_INTERVAL, gzip_cache_size=GZIP_CACHE_SIZE,
+                 request_timeout=REQUEST_TIMEOUT, max_header_size=MAX_HEADER_SIZE, path_cache_ttl=PATH_CACHE_TTL,
+                 server_status=False, drain_timeout=DRAIN_TIMEOUT):
         self.document_root = document_root
         self.host = host
         self.port = port
         self.workers = workers
+        self.engine = engine
+        self.processes = processes
+        self.reuse_port = reuse_port
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+        self.request_timeout = request_timeout
+        self.max_header_size = max_header_size
+        self.cache_size = cache_size
+        self.cache_max_file_size = cache_max_file_size
+        self.cache_check_interval = cache_check_interval
+        self.gzip_cache_size = gzip_cache_size
+        self.path_cache_ttl = path_cache_ttl
+        self.create_caches()
+        self.server_status = server_status
+        self.drain_timeout = drain_timeout
         self.tread_poll = []
+        # workers replaced by a reload, finishing their connections
+        self.retired_workers = []
+        self.children = {}
+        # children replaced by a reload, finishing their connections
+        self.retiring = set()
+        self.server_socket = None
 
-    def run(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(
+    def create_caches(self):
+        # every worker process fills its own cache, threads of a process share it
+        self.file_cache = (
+            FileCache(self.cache_size, self.cache_max_file_size, self.cache_check_interval)
+            if self.cache_size else None
+        )
+        self.gzip_cache = GzipCache(self.gzip_cache_size) if self.gzip_cache_size else None
+        self.path_resolver = PathResolver(self.document_root, self.path_cache_ttl)
+
+    def create_socket(self, reuse_port=False):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(
             socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen()
+        if reuse_port:
+            # the kernel balances new connections between the sockets
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(LISTEN_BACKLOG)
+        if self.engine == ENGINE_THREAD:
+            # blocking accept, woken up now and then to notice a stop
+            server_socket.settimeout(SELECT_TIMEOUT)
+        else:
+            server_socket.setblocking(False)
+        return server_socket
+
+    def start_workers(self):
+        worker_class = WORKER_CLASSES[self.engine]
+        self.tread_poll = []
         for _ in range(self.workers):
-            worker = Worker(
+            worker = worker_class(
                 self.host, self.port,
                 self.server_socket,
-                self.document_root
+                self.document_root,
+                keepalive_timeout=self.keepalive_timeout,
+                keepalive_requests=self.keepalive_requests,
+                file_cache=self.file_cache,
+                gzip_cache=self.gzip_cache,
+                path_resolver=self.path_resolver,
+                request_timeout=self.request_timeout,
+                max_header_size=self.max_header_size,
+                status_page=self.render_status if self.server_status else None
             )
             worker.start()
             self.tread_poll.append(worker)
 
+    def render_status(self):
+        # every worker process reports only its own workers and caches
+        caches = [
+            (name, cache) for name, cache in
+            [("file", self.file_cache), ("gzip", self.gzip_cache), ("path", self.path_resolver)]
+            if cache is not None
+        ]
+        return render_metrics([worker.metrics for worker in self.tread_poll], caches)
+
+    def reload_workers(self):
+        # new workers with empty caches start accepting on the same socket
+        # before the old ones stop, the old ones finish their connections
+        old_workers = self.tread_poll
+        self.create_caches()
+        self.start_workers()
+        for worker in old_workers:
+            worker.stop()
+        self.retired_workers = [worker for worker in self.retired_workers + old_workers if worker.is_alive()]
+        logging.info("Reloaded workers in process %s" % os.getpid())
+
+    def drain_workers(self):
+        workers = self.tread_poll + self.retired_workers
+        for worker in workers:
+            worker.stop()
+        deadline = time.monotonic() + self.drain_timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        dropped = sum(worker.metrics.active for worker in workers if worker.is_alive())
+        if dropped:
+            logging.warning("Drain timed out in process %s, dropping %s connections" % (os.getpid(), dropped))
+
+    def run(self):
+        # signals are blocked before any thread starts, so workers inherit the
+        # mask and only the supervisor below receives them, with sigwait
+        signal.pthread_sigmask(signal.SIG_BLOCK, SUPERVISOR_SIGNALS | {signal.SIGCHLD, signal.SIGALRM})
+        if self.processes:
+            self.run_prefork()
+            return
+
+        self.server_socket = self.create_socket()
+        self.start_workers()
+
         while True:
-            pass
+            signum = signal.sigwait(SUPERVISOR_SIGNALS)
+            if signum == signal.SIGHUP:
+                self.reload_workers()
+            else:
+                logging.info("Draining connections")
+                self.drain_workers()
+                return
+
+    def run_worker_process(self):
+        # reloads are done by the master, which replaces whole processes
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self.reuse_port:
+            self.server_socket = self.create_socket(reuse_port=True)
+        self.start_workers()
+        while True:
+            if wait_signal({signal.SIGTERM, signal.SIGINT}, CHILD_CHECK_INTERVAL) is not None:
+                self.drain_workers()
+                return 0
+            # a worker thread only stops on an unexpected error, let the
+            # master replace the whole process then
+            if not all(worker.is_alive() for worker in self.tread_poll):
+                logging.error("Worker thread died in process %s" % os.getpid())
+                return 1
+
+    def spawn_process(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = self.run_worker_process()
+            except BaseException:
+                logging.exception("Worker process %s failed" % os.getpid())
+            finally:
+                os._exit(status)
+        self.children[pid] = time.monotonic()
+        logging.info("Started worker process %s" % pid)
+
+    def signal_children(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap_children(self):
+        # returns (pid, status, started) of current children that exited,
+        # retired ones are just forgotten
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            self.retiring.discard(pid)
+            started = self.children.pop(pid, None)
+            if started is not None:
+                exited.append((pid, status, started))
+        return exited
+
+    def reload_children(self):
+        # new children start accepting before the old ones stop, with a shared
+        # socket no connection is refused in between
+        old_children = list(self.children)
+        self.children = {}
+        for _ in range(self.processes):
+            self.spawn_process()
+        self.retiring.update(old_children)
+        self.signal_children(old_children, signal.SIGTERM)
+        logging.info("Reloaded worker processes, %s old ones draining" % len(self.retiring))
+
+    def stop_children(self):
+        self.retiring.update(self.children)
+        self.children = {}
+        self.signal_children(self.retiring, signal.SIGTERM)
+        # children enforce drain_timeout themselves, this is the last resort
+        deadline = time.monotonic() + self.drain_timeout + CHILD_CHECK_INTERVAL
+        while self.retiring and time.monotonic() < deadline:
+            wait_signal({signal.SIGCHLD}, min(CHILD_CHECK_INTERVAL, max(0, deadline - time.monotonic())))
+            self.reap_children()
+        if self.retiring:
+            logging.error("Killing worker processes %s" % sorted(self.retiring))
+            self.signal_children(self.retiring, signal.SIGKILL)
+
+    def run_prefork(self):
+        if not self.reuse_port:
+            # shared by all children, each of them accepts on it
+            self.server_socket = self.create_socket()
+        for _ in range(self.processes):
+            self.spawn_process()
+
+        while True:
+            # SIGCHLD wakes the loop up too, the timeout is only a safety net
+            signum = wait_signal(SUPERVISOR_SIGNALS | {signal.SIGCHLD}, CHILD_CHECK_INTERVAL)
+            if signum == signal.SIGHUP:
+                self.reload_children()
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                logging.info("Draining worker processes")
+                self.stop_children()
+                return
 
+            for pid, status, started in self.reap_children():
+                logging.error("Worker process %s exited with status %s, restarting" % (pid, status))
+                if time.monotonic() - started < RESTART_MIN_UPTIME:
+                    # do not fork in a tight loop if children die right away
+                    time.sleep(RESTART_DELAY)
+                self.spawn_process()
 
 
 if __name__ == "__main__":
@@ -210,6 +1704,36 @@ if __name__ == "__main__":
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("-w", "--workers", action="store", type=int, default=2)
+    op.add_option("-e", "--engine", action="store", type="choice", choices=ENGINES, default=ENGINE_THREAD,
+                  help="thread: blocking worker threads, epoll: one event loop per worker, "
+                       "asyncio: one asyncio loop per worker")
+    op.add_option("-P", "--processes", action="store", type=int, default=0,
+                  help="pre-fork this many worker processes, each running --workers workers")
+    op.add_option("--reuseport", action="store_true", default=False,
+                  help="give every worker process its own SO_REUSEPORT listening socket")
+    op.add_option("--keepalive-timeout", action="store", type=float, default=KEEPALIVE_TIMEOUT,
+                  help="seconds an idle keep-alive connection is kept open")
+    op.add_option("--keepalive-requests", action="store", type=int, default=KEEPALIVE_REQUESTS,
+                  help="requests served on one connection before it is closed")
+    op.add_option("--request-timeout", action="store", type=float, default=REQUEST_TIMEOUT,
+                  help="seconds a client has to send a whole request head")
+    op.add_option("--max-header-size", action="store", type=int, default=MAX_HEADER_SIZE,
+                  help="bytes, bigger request heads are answered with 431")
+    op.add_option("--cache-size", action="store", type=int, default=CACHE_SIZE // 1024 // 1024,
+                  help="megabytes of small files kept in memory, 0 turns the cache off")
+    op.add_option("--cache-max-file", action="store", type=int, default=CACHE_MAX_FILE_SIZE // 1024,
+                  help="kilobytes, bigger files are never cached")
+    op.add_option("--cache-check-interval", action="store", type=float, default=CACHE_CHECK_INTERVAL,
+                  help="seconds a cached file is served before its mtime and size are checked again")
+    op.add_option("--path-cache-ttl", action="store", type=float, default=PATH_CACHE_TTL,
+                  help="seconds url to file lookups, 404s included, are remembered, 0 turns it off")
+    op.add_option("--gzip-cache-size", action="store", type=int, default=GZIP_CACHE_SIZE // 1024 // 1024,
+                  help="megabytes of gzipped text files, 0 turns off compression on the fly "
+                       "(precompressed .gz files are still served)")
+    op.add_option("--server-status", action="store_true", default=False,
+                  help="serve Prometheus metrics of the answering process on " + STATUS_PATH)
+    op.add_option("--drain-timeout", action="store", type=float, default=DRAIN_TIMEOUT,
+                  help="seconds open connections get to finish on SIGTERM")
     op.add_option("-r", "--document_root",
                   action="store", type=str, default="")
     (opts, args) = op.parse_args()
@@ -220,5 +1744,19 @@ if __name__ == "__main__":
         host=opts.host,
         port=opts.port,
         workers=opts.workers,
+        engine=opts.engine,
+        processes=opts.processes,
+        reuse_port=opts.reuseport,
+        keepalive_timeout=opts.keepalive_timeout,
+        keepalive_requests=opts.keepalive_requests,
+        cache_size=opts.cache_size * 1024 * 1024,
+        cache_max_file_size=opts.cache_max_file * 1024,
+        cache_check_interval=opts.cache_check_interval,
+        gzip_cache_size=opts.gzip_cache_size * 1024 * 1024,
+        request_timeout=opts.request_timeout,
+        max_header_size=opts.max_header_size,
+        path_cache_ttl=opts.path_cache_ttl,
+        server_status=opts.server_status,
+        drain_timeout=opts.drain_timeout,
     )
     server.run()
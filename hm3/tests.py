@@ -0,0 +1,248 @@
+import gzip
+import os
+import tempfile
+import unittest
+from email.utils import formatdate
+from httpd import (
+    RequestReader, HeaderTooLarge, parse_range, resolve_path, accepts_gzip, build_response,
+    FileCache, GzipCache, CachedFile, LRUCache, PathResolver, MAX_RANGES, OK, NOT_FOUND, FORBIDDEN,
+    NOT_MODIFIED
+)
+
+
+def write_file(path, data):
+    with open(path, "wb") as file:
+        file.write(data)
+    return path
+
+
+class TestRequestReader(unittest.TestCase):
+    def test_terminator_split_across_feeds(self):
+        reader = RequestReader()
+        self.assertEqual(reader.feed(b"GET / HTTP/1.1\r\nHost: x\r\n\r"), [])
+        self.assertEqual(reader.feed(b"\n"), [b"GET / HTTP/1.1\r\nHost: x\r\n\r\n"])
+        self.assertEqual(reader.buffer, b"")
+
+    def test_byte_by_byte(self):
+        reader = RequestReader()
+        head = b"GET / HTTP/1.1\r\n\r\n"
+        requests = []
+        for byte in head:
+            requests.extend(reader.feed(bytes([byte])))
+        self.assertEqual(requests, [head])
+
+    def test_pipelined_heads(self):
+        reader = RequestReader()
+        first = b"GET /a HTTP/1.1\r\n\r\n"
+        second = b"HEAD /b HTTP/1.1\r\n\r\n"
+        self.assertEqual(reader.feed(first + second + b"GET /c"), [first, second])
+        self.assertEqual(reader.buffer, b"GET /c")
+
+    def test_header_too_large(self):
+        head = b"GET / HTTP/1.1\r\nX: " + b"a" * 20 + b"\r\n\r\n"
+        self.assertEqual(RequestReader(len(head)).feed(head), [head])
+        with self.assertRaises(HeaderTooLarge):
+            RequestReader(len(head) - 1).feed(head)
+        with self.assertRaises(HeaderTooLarge):
+            # no terminator yet, but already over the limit
+            RequestReader(10).feed(b"GET / HTTP/1.1\r\nX: y")
+
+
+class TestParseRange(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range("bytes=0-9", 100), [(0, 9)])
+        self.assertEqual(parse_range("bytes=90-", 100), [(90, 99)])
+        self.assertEqual(parse_range("bytes=50-1000", 100), [(50, 99)])
+        self.assertEqual(parse_range("bytes=0-0, 5-6", 100), [(0, 0), (5, 6)])
+
+    def test_suffix_ranges(self):
+        self.assertEqual(parse_range("bytes=-10", 100), [(90, 99)])
+        self.assertEqual(parse_range("bytes=-1000", 100), [(0, 99)])
+        self.assertEqual(parse_range("bytes=-0", 100), [])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range("bytes=100-", 100), [])
+        self.assertEqual(parse_range("bytes=200-300", 100), [])
+
+    def test_invalid_specs_are_ignored(self):
+        for header in ["items=0-1", "bytes=", "bytes=-", "bytes=5", "bytes=9-3", "bytes=a-1",
+                       "bytes=1-b", "bytes=\xb2-", "bytes=0-\xb9", "bytes=١-"]:
+            self.assertIsNone(parse_range(header, 100), header)
+
+    def test_max_ranges(self):
+        specs = ",".join("%d-%d" % (i, i) for i in range(MAX_RANGES))
+        self.assertEqual(len(parse_range("bytes=" + specs, 100)), MAX_RANGES)
+        self.assertIsNone(parse_range("bytes=" + specs + ",50-51", 100))
+
+
+class TestResolvePath(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        base = os.path.realpath(self.tmp_dir.name)
+        self.root = os.path.join(base, "root")
+        os.makedirs(os.path.join(self.root, "dir"))
+        write_file(os.path.join(self.root, "dir", "index.html"), b"index")
+        write_file(os.path.join(self.root, "page.html"), b"page")
+        self.outside = write_file(os.path.join(base, "secret.html"), b"secret")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_files_and_index(self):
+        self.assertEqual(resolve_path(self.root, "/page.html"), (OK, os.path.join(self.root, "page.html")))
+        self.assertEqual(resolve_path(self.root, "/dir/"), (OK, os.path.join(self.root, "dir", "index.html")))
+        self.assertEqual(resolve_path(self.root, "/nope.html")[0], NOT_FOUND)
+        self.assertEqual(resolve_path(self.root, "/dir")[0], FORBIDDEN)
+
+    def test_dot_dot_escape(self):
+        self.assertEqual(resolve_path(self.root, "/../secret.html")[0], FORBIDDEN)
+        self.assertEqual(resolve_path(self.root, "/dir/../../secret.html")[0], FORBIDDEN)
+        self.assertEqual(resolve_path(self.root, "/dir/../page.html")[0], OK)
+
+    def test_symlink_out_of_root(self):
+        os.symlink(self.outside, os.path.join(self.root, "link.html"))
+        self.assertEqual(resolve_path(self.root, "/link.html")[0], FORBIDDEN)
+        os.symlink(os.path.dirname(self.outside), os.path.join(self.root, "up"))
+        self.assertEqual(resolve_path(self.root, "/up/secret.html")[0], FORBIDDEN)
+        self.assertEqual(resolve_path(self.root, "/up/root/page.html")[0], OK)
+
+    def test_path_resolver(self):
+        resolver = PathResolver(self.root, ttl=60)
+        for _ in range(2):
+            self.assertEqual(resolver.resolve("/../secret.html")[0], FORBIDDEN)
+            self.assertEqual(resolver.resolve("/page.html"), (OK, os.path.join(self.root, "page.html")))
+        self.assertEqual((resolver.hits, resolver.misses), (2, 2))
+
+    def test_requests_can_not_escape(self):
+        resolver = PathResolver(self.root)
+        os.symlink(self.outside, os.path.join(self.root, "link.html"))
+        for url in ["/../secret.html", "/%2e%2e/secret.html", "/dir/..%2f..%2fsecret.html", "/link.html"]:
+            for path_resolver in (None, resolver):
+                response = build_response(
+                    ("GET %s HTTP/1.1\r\n\r\n" % url).encode(), self.root, path_resolver=path_resolver)
+                self.assertEqual(response.status, FORBIDDEN, url)
+
+    def test_precompressed_symlink_out_of_root(self):
+        # a.html.gz pointing outside must not be sent for a gzip request of a.html
+        write_file(os.path.join(self.root, "a.html"), b"a" * 1000)
+        write_file(self.outside, gzip.compress(b"secret"))
+        os.symlink(self.outside, os.path.join(self.root, "a.html.gz"))
+        for path_resolver in (None, PathResolver(self.root)):
+            response = build_response(
+                b"GET /a.html HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n", self.root,
+                path_resolver=path_resolver
+            )
+            self.assertEqual(response.status, OK)
+            self.assertIsNone(response.encoded_path)
+            self.assertEqual(response.body, [b"a" * 1000])
+
+
+class TestConditionalRequests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.path = write_file(os.path.join(self.root, "page.html"), b"page")
+        os.utime(self.path, (1500000000, 1500000000))
+        self.etag = self.get().response_headers["ETag"]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def get(self, **headers):
+        head = "GET /page.html HTTP/1.1\r\n" + "".join("%s: %s\r\n" % item for item in headers.items()) + "\r\n"
+        return build_response(head.encode("latin-1"), self.root)
+
+    def test_if_none_match(self):
+        self.assertEqual(self.get(**{"If-None-Match": self.etag}).status, NOT_MODIFIED)
+        self.assertEqual(self.get(**{"If-None-Match": '"x", ' + self.etag}).status, NOT_MODIFIED)
+        self.assertEqual(self.get(**{"If-None-Match": "*"}).status, NOT_MODIFIED)
+        self.assertEqual(self.get(**{"If-None-Match": '"x"'}).status, OK)
+
+    def test_weak_tag(self):
+        self.assertEqual(self.get(**{"If-None-Match": "W/" + self.etag}).status, NOT_MODIFIED)
+
+    def test_if_modified_since(self):
+        self.assertEqual(
+            self.get(**{"If-Modified-Since": formatdate(1500000000, usegmt=True)}).status, NOT_MODIFIED)
+        self.assertEqual(self.get(**{"If-Modified-Since": formatdate(1499999999, usegmt=True)}).status, OK)
+        self.assertEqual(self.get(**{"If-Modified-Since": "yesterday"}).status, OK)
+
+    def test_if_none_match_wins(self):
+        response = self.get(**{
+            "If-None-Match": '"x"',
+            "If-Modified-Since": formatdate(1500000000, usegmt=True),
+        })
+        self.assertEqual(response.status, OK)
+
+
+class TestAcceptsGzip(unittest.TestCase):
+    def test_accepted(self):
+        for header in ["gzip", "gzip, deflate", "deflate, gzip;q=0.5", "*", "br, *", "GZIP;Q=1"]:
+            self.assertTrue(accepts_gzip(header), header)
+
+    def test_refused(self):
+        for header in ["", "br", "identity", "gzip;q=0", "gzip;Q=0", "gzip;q=x",
+                       "*;q=1, gzip;q=0", "gzip;q=0, *", "*;q=0"]:
+            self.assertFalse(accepts_gzip(header), header)
+
+
+class TestCaches(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, data):
+        return write_file(os.path.join(self.tmp_dir.name, name), data)
+
+    def test_lru_eviction(self):
+        cache = LRUCache(30)
+        for key in "abc":
+            cache.put(key, CachedFile(10, 0, None, b"x" * 10))
+        cache.lookup("a")
+        cache.put("d", CachedFile(10, 0, None, b"x" * 10))
+        self.assertEqual(list(cache.entries), ["c", "a", "d"])
+        self.assertEqual(cache.size, 30)
+        cache.put("a", CachedFile(25, 0, None, b"x" * 25))
+        self.assertEqual(list(cache.entries), ["a"])
+        self.assertEqual(cache.size, 25)
+
+    def test_file_cache_budget(self):
+        cache = FileCache(max_size=250, max_file_size=100, check_interval=60)
+        paths = [self.write("%d.html" % number, b"x" * 100) for number in range(3)]
+        for path in paths:
+            self.assertEqual(cache.get(path).body, b"x" * 100)
+        self.assertEqual(cache.size, 200)
+        self.assertEqual(list(cache.entries), paths[1:])
+        self.assertIs(cache.get(paths[2]), cache.entries[paths[2]])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_file_cache_too_big(self):
+        cache = FileCache(max_size=1000, max_file_size=100, check_interval=60)
+        path = self.write("big.html", b"x" * 101)
+        self.assertIsNone(cache.get(path))
+        self.assertIsNone(cache.get(path))
+        self.assertEqual((cache.misses, cache.bypassed), (1, 1))
+
+    def test_gzip_cache_budget(self):
+        data = b"compress me " * 100
+        paths = [self.write("%d.css" % number, data) for number in range(3)]
+        size = len(GzipCache().get(paths[0], 0, len(data)))
+        cache = GzipCache(max_size=size * 2)
+        for path in paths:
+            self.assertEqual(len(cache.get(path, 0, len(data))), size)
+        self.assertEqual(cache.size, size * 2)
+        self.assertEqual([key[0] for key in cache.entries], paths[1:])
+
+    def test_gzip_cache_skips_incompressible(self):
+        path = self.write("random.css", os.urandom(1000))
+        cache = GzipCache()
+        self.assertIsNone(cache.get(path, 0, 1000))
+        self.assertIsNone(cache.get(path, 0, 1000))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertGreater(cache.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()